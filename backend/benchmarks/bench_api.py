@@ -0,0 +1,199 @@
+"""Load test the API end to end without MongoDB or Auth0.
+
+The app runs in-process behind an in-memory, Mongo compatible database
+(mongomock-motor) and verifies real tokens signed with a generated key set.
+After seeding synthetic hospitals, requirements, helpers and profiles,
+concurrent clients drive each endpoint in turn. Latencies and throughput are
+reported per endpoint. Run with::
+
+    python benchmarks/bench_api.py --requests 1000 --concurrency 20 --output results.json
+"""
+
+import asyncio
+import json
+import random
+import time
+
+import click
+import httpx
+import numpy as np
+from authlib.jose import JsonWebKey, jwt
+from bson import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+from bench_matching import GERMANY, generate_problem
+from wirvsvirus import api, auth, db, models
+from wirvsvirus.settings import settings
+
+GRAPHQL_QUERY = """
+query {
+    hospitals(first: 20) {
+        id
+        name
+        personnelRequirements {activityId value}
+    }
+}
+"""
+
+
+def use_memory_database():
+    """Serve the database from memory."""
+    database = AsyncMongoMockClient()["wirvsvirus"]
+    db.db.database = database
+    db.db.analytics_database = database
+
+
+def use_stub_key_set():
+    """Verify tokens with a generated key set, returns its private key."""
+    key = JsonWebKey.generate_key("RSA", 2048, is_private=True, options={"kid": "benchmark"})
+
+    async def source():
+        return auth.JWKS(keys=[key.as_dict(is_private=False)])
+
+    auth.jwks_manager.source = source
+    return key
+
+
+def create_token(key, user_id):
+    """Create a signed access token for a user."""
+    payload = {"sub": user_id, "iss": settings.auth_issuer, "exp": int(time.time()) + 24 * 3600}
+    return jwt.encode({"alg": "RS256"}, payload, key).decode()
+
+
+def random_helper(rng, activity_ids, location=None):
+    """Create a helper."""
+    n = rng.randrange(10 ** 9)
+    return models.HelperBase(
+        first_name=f"First{n}", last_name=f"Last{n}", email=f"helper{n}@example.com",
+        qualification_id=rng.choice(["none", "nurse", "doctor"]), work_experience_in_years=rng.randint(0, 30),
+        activity_ids=activity_ids, location=location)
+
+
+async def seed(n_hospitals, n_helpers, n_users, rng) -> list:
+    """Seed the database, returns the user ids with a profile."""
+    hospitals, helpers = generate_problem(n_hospitals, n_helpers, seed=rng.randrange(2 ** 32))
+    database = db.get_database()
+
+    hospital_documents, requirements = [], []
+    for i, hospital in enumerate(hospitals):
+        document = {**models.HospitalBase(name=f"Hospital {i}", address=f"Street {i}",
+                                          location=hospital["location"]).dict(), "_id": ObjectId()}
+        hospital_documents.append(document)
+        requirements.extend(
+            models.PersonnelRequirementBase(hospital_id=str(document["_id"]), activity_id=role, value=value).dict()
+            for role, value in hospital["demand"].items() if value > 0)
+    helper_documents = [{**random_helper(rng, helper["activity_ids"], helper["location"]).dict(), "_id": ObjectId()}
+                        for helper in helpers]
+    user_ids = [f"benchmark|{k}" for k in range(min(n_users, n_helpers))]
+    profiles = [models.ProfileIntermediate(user_id=user_id, email=helper["email"], profile_type="helper",
+                                           helper_id=str(helper["_id"])).dict()
+                for user_id, helper in zip(user_ids, helper_documents)]
+
+    for collection, documents in [("hospitals", hospital_documents), ("personnel_requirements", requirements),
+                                  ("helpers", helper_documents), ("profiles", profiles)]:
+        if documents:
+            await database[collection].insert_many(documents)
+    return user_ids
+
+
+def random_point(rng):
+    """Random (lon, lat) point in Germany's bounding box."""
+    (min_lon, min_lat), (max_lon, max_lat) = GERMANY
+    return rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)
+
+
+def endpoint_requests(tokens):
+    """Request factories per endpoint, each returning (method, url, options)."""
+    def headers(rng):
+        return {"Authorization": f"Bearer {rng.choice(tokens)}"}
+
+    def nearest_hospital(rng):
+        lon, lat = random_point(rng)
+        return "POST", "/nearest_hospital", {"params": {"lon": lon, "lat": lat, "k": 5}}
+
+    def helpers(rng):
+        helper = random_helper(rng, sorted({rng.choice(list(models.RoleEnum)).value}))
+        return "POST", "/helpers", {"json": helper.dict(by_alias=True), "headers": headers(rng)}
+
+    return {
+        "profile": lambda rng: ("GET", "/profile", {"headers": headers(rng)}),
+        "nearest_hospital": nearest_hospital,
+        "graphql": lambda rng: ("POST", "/graphql", {"json": {"query": GRAPHQL_QUERY}, "headers": headers(rng)}),
+        "propositions": lambda rng: ("GET", "/matches/propositions", {"headers": headers(rng)}),
+        "helpers": helpers,
+    }
+
+
+async def drive(client, make_request, n_requests, concurrency, rng) -> dict:
+    """Send requests from concurrent clients and summarize the latencies."""
+    latencies, errors = [], 0
+    remaining = iter(range(n_requests))
+
+    async def run_client():
+        nonlocal errors
+        for _ in remaining:
+            method, url, options = make_request(rng)
+            start = time.perf_counter()
+            response = await client.request(method, url, **options)
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code >= 400
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {"requests": n_requests, "errors": errors, "seconds": elapsed, "requests_per_second": n_requests / elapsed,
+            "mean_ms": 1000 * float(np.mean(latencies)), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+
+
+async def benchmark(endpoints, n_requests, concurrency, n_hospitals, n_helpers, n_users, seed_value) -> dict:
+    rng = random.Random(seed_value)
+    use_memory_database()
+    key = use_stub_key_set()
+    settings.auth_enabled = True
+    settings.spatial_index_in_memory = True
+
+    start = time.perf_counter()
+    user_ids = await seed(n_hospitals, n_helpers, n_users, rng)
+    seed_seconds = time.perf_counter() - start
+    # the startup events aren't run for the in-process client
+    await auth.jwks_manager.refresh()
+    await api.load_hospital_index()
+
+    tokens = [create_token(key, user_id) for user_id in user_ids]
+    factories = endpoint_requests(tokens)
+    results = {}
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        for endpoint in endpoints:
+            results[endpoint] = await drive(client, factories[endpoint], n_requests, concurrency, rng)
+            click.echo(f"{endpoint:<18} {results[endpoint]['requests_per_second']:8.1f} req/s  "
+                       f"p50 {results[endpoint]['p50_ms']:7.1f}ms  p95 {results[endpoint]['p95_ms']:7.1f}ms  "
+                       f"p99 {results[endpoint]['p99_ms']:7.1f}ms  {results[endpoint]['errors']} errors", err=True)
+    api.propositions.reset()
+    return {"hospitals": n_hospitals, "helpers": n_helpers, "users": len(user_ids), "concurrency": concurrency,
+            "seed_seconds": seed_seconds, "endpoints": results}
+
+
+@click.command()
+@click.option("--endpoint", "endpoints", multiple=True,
+              type=click.Choice(["profile", "nearest_hospital", "graphql", "propositions", "helpers"]),
+              default=["profile", "nearest_hospital", "graphql", "propositions", "helpers"], show_default=True,
+              help="endpoints to benchmark, in order")
+@click.option("--requests", "n_requests", default=500, show_default=True, help="requests per endpoint")
+@click.option("--concurrency", default=20, show_default=True, help="concurrent clients")
+@click.option("--hospitals", "n_hospitals", default=500, show_default=True)
+@click.option("--helpers", "n_helpers", default=2000, show_default=True)
+@click.option("--users", "n_users", default=200, show_default=True, help="helpers with a profile and token")
+@click.option("--seed", default=0)
+@click.option("--output", type=click.File("w"), default="-", help="file to write the json results to")
+def main(endpoints, n_requests, concurrency, n_hospitals, n_helpers, n_users, seed, output):
+    """Drive concurrent traffic against the API and print the results as json."""
+    results = asyncio.get_event_loop().run_until_complete(
+        benchmark(endpoints, n_requests, concurrency, n_hospitals, n_helpers, n_users, seed))
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Benchmark the matching model on synthetic problems.
+
+Hospitals and helpers are scattered around random cities in Germany's
+bounding box. Helpers offer one or two of the ``RoleEnum`` activities and
+hospitals demand them with exponentially distributed amounts. Every run times
+the phases of ``MatchingModel`` and records the peak memory in a fresh
+process. Run with::
+
+    python benchmarks/bench_matching.py --helpers 1000 --helpers 10000 \\
+        --engine cp_sat --engine min_cost_flow --output results.json
+"""
+
+import functools
+import json
+import multiprocessing
+import random
+import resource
+import time
+import tracemalloc
+
+import click
+
+from wirvsvirus.matching import MatchingModel
+from wirvsvirus.models import RoleEnum
+
+# bounding box of Germany as (lon, lat)
+GERMANY = ((5.9, 47.3), (15.0, 55.1))
+
+# share of helpers offering each activity
+ROLE_WEIGHTS = {RoleEnum.medical: 0.5, RoleEnum.logistic: 0.3, RoleEnum.admin: 0.2}
+
+# phases of the model building, the remaining time of "solve" is spent solving
+MODEL_PHASES = ("variables", "constraints", "objective", "results")
+
+
+def timed(phase, method):
+    """Wrap a method to add its run time to the phase timings."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.0) + time.perf_counter() - start
+    return wrapper
+
+
+class TimedMatchingModel(MatchingModel):
+    """Matching model recording the time spent in each phase."""
+
+    def __init__(self, *args, **kwargs):
+        self.timings = {}
+        super().__init__(*args, **kwargs)
+
+    index_skills = timed("skills", MatchingModel.index_skills)
+    calculate_distances = timed("distances", MatchingModel.calculate_distances)
+    find_edges = timed("edges", MatchingModel.find_edges)
+    find_candidate_edges = timed("edges", MatchingModel.find_candidate_edges)
+    find_nearby_edges = timed("edges", MatchingModel.find_nearby_edges)
+    create_variables = timed("variables", MatchingModel.create_variables)
+    add_constraints = timed("constraints", MatchingModel.add_constraints)
+    add_objective = timed("objective", MatchingModel.add_objective)
+    get_results = timed("results", MatchingModel.get_results)
+    solve = timed("total_solve", MatchingModel.solve)
+
+    def phase_timings(self):
+        """Timings per phase in seconds, with the pure solve time split off."""
+        timings = dict(self.timings)
+        timings["solve"] = timings.pop("total_solve") - sum(timings.get(phase, 0.0) for phase in MODEL_PHASES)
+        return timings
+
+
+def generate_problem(n_hospitals, n_helpers, demand_ratio=0.5, n_cities=30, spread=0.3, seed=0):
+    """Generate hospitals and helpers clustered around random cities."""
+    rng = random.Random(seed)
+    (min_lon, min_lat), (max_lon, max_lat) = GERMANY
+    cities = [(rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)) for _ in range(n_cities)]
+
+    def location():
+        lon, lat = rng.choice(cities)
+        lon = min(max(rng.gauss(lon, spread), min_lon), max_lon)
+        lat = min(max(rng.gauss(lat, spread), min_lat), max_lat)
+        return {"type": "Point", "coordinates": [lon, lat]}
+
+    roles = [role.value for role in ROLE_WEIGHTS]
+    weights = list(ROLE_WEIGHTS.values())
+    hospitals = []
+    for i in range(n_hospitals):
+        demand = {}
+        for role, weight in zip(roles, weights):
+            mean = demand_ratio * n_helpers * weight / n_hospitals
+            demand[role] = int(rng.expovariate(1 / mean)) if mean > 0 else 0
+        hospitals.append({"_id": f"hospital-{i}", "location": location(), "demand": demand})
+    helpers = [
+        {"_id": f"helper-{j}", "location": location(),
+         "activity_ids": sorted(set(rng.choices(roles, weights, k=rng.randint(1, 2))))}
+        for j in range(n_helpers)
+    ]
+    return hospitals, helpers
+
+
+def run(config):
+    """Run a single benchmark, meant to be called in a fresh process."""
+    hospitals, helpers = generate_problem(
+        config["hospitals"], config["helpers"], config["demand_ratio"], seed=config["seed"])
+    if config["tracemalloc"]:
+        tracemalloc.start()
+    start = time.perf_counter()
+    model = TimedMatchingModel(
+        hospitals, helpers, sparse=config["sparse"], max_distance=config["max_distance"],
+        metric=config["metric"], engine=config["engine"], max_time=config["max_time"],
+        num_workers=config["num_workers"])
+    model.solve()
+    total = time.perf_counter() - start
+    result = {
+        **config,
+        "edges": len(model.edges),
+        "status": model.results["status"],
+        "objective": model.results["objective"],
+        "bound": model.results["bound"],
+        "allocated": sum(len(a["helper_ids"]) for a in model.results["allocations"]),
+        "timings": model.phase_timings(),
+        "total_seconds": total,
+        # ru_maxrss is in kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if config["tracemalloc"]:
+        result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result
+
+
+@click.command()
+@click.option("--helpers", "helper_counts", multiple=True, type=int, default=[1000], show_default=True,
+              help="number of helpers, repeat to benchmark several sizes")
+@click.option("--hospitals", "n_hospitals", default=1000, show_default=True, help="number of hospitals")
+@click.option("--engine", "engines", multiple=True, type=click.Choice(MatchingModel.engines),
+              default=["cp_sat"], show_default=True, help="repeat to compare engines")
+@click.option("--dense", is_flag=True, help="model every (hospital, helper) pair")
+@click.option("--metric", type=click.Choice(["euclidean", "haversine"]), default="haversine", show_default=True)
+@click.option("--max-distance", type=float, default=50, show_default=True,
+              help="drop pairs farther apart (km for haversine), negative for no limit")
+@click.option("--demand-ratio", default=0.5, show_default=True, help="total demand per helper")
+@click.option("--max-time", type=float, default=60, show_default=True, help="CP-SAT time limit in seconds")
+@click.option("--num-workers", type=int, help="CP-SAT search workers")
+@click.option("--tracemalloc", "trace", is_flag=True, help="also trace python allocations (slower)")
+@click.option("--seed", default=0)
+@click.option("--output", type=click.File("w"), default="-", help="file to write the json results to")
+def main(helper_counts, n_hospitals, engines, dense, metric, max_distance, demand_ratio, max_time, num_workers,
+         trace, seed, output):
+    """Time the matching phases on synthetic problems and print the results as json."""
+    configs = [
+        {"hospitals": n_hospitals, "helpers": n_helpers, "engine": engine, "sparse": not dense,
+         "metric": metric, "max_distance": max_distance if max_distance >= 0 else None,
+         "demand_ratio": demand_ratio, "max_time": max_time, "num_workers": num_workers,
+         "tracemalloc": trace, "seed": seed}
+        for n_helpers in helper_counts for engine in engines
+    ]
+    results = []
+    # a fresh process per run, so the peak memory isn't carried over
+    context = multiprocessing.get_context("spawn")
+    for config in configs:
+        with context.Pool(1) as pool:
+            result = pool.apply(run, (config,))
+        click.echo(f"{config['engine']} with {config['helpers']} helpers: {result['total_seconds']:.2f}s, "
+                   f"{result['status']}", err=True)
+        results.append(result)
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
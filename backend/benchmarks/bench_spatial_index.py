@@ -0,0 +1,70 @@
+"""Benchmark nearest hospital lookups.
+
+Compares a linear scan with ``calc_line_distance`` (how /nearest_hospital
+used to work) with the in-memory ``GridIndex``. Run with::
+
+    python benchmarks/bench_spatial_index.py --hospitals 2800 --queries 1000
+"""
+
+import json
+import random
+import time
+
+import click
+
+from wirvsvirus.api import calc_line_distance
+from wirvsvirus.spatial import GridIndex
+
+# bounding box of Germany as (lon, lat)
+GERMANY = ((5.9, 47.3), (15.0, 55.1))
+
+
+def random_point():
+    """Random (lon, lat) point in Germany's bounding box."""
+    (min_lon, min_lat), (max_lon, max_lat) = GERMANY
+    return (random.uniform(min_lon, max_lon), random.uniform(min_lat, max_lat))
+
+
+def scan_nearest(hospitals, lon, lat):
+    """Find the nearest hospital by scanning all of them."""
+    return min(range(len(hospitals)), key=lambda i: calc_line_distance(lon, lat, *hospitals[i]))
+
+
+@click.command()
+@click.option("--hospitals", "n_hospitals", default=2800, help="number of hospitals")
+@click.option("--queries", "n_queries", default=1000, help="number of lookups")
+@click.option("--cell-size", default=0.1, help="grid cell size in degrees")
+@click.option("--seed", default=0)
+def main(n_hospitals, n_queries, cell_size, seed):
+    """Time nearest hospital lookups and print the results as json."""
+    random.seed(seed)
+    hospitals = [random_point() for _ in range(n_hospitals)]
+    queries = [random_point() for _ in range(n_queries)]
+
+    start = time.perf_counter()
+    scanned = [scan_nearest(hospitals, lon, lat) for lon, lat in queries]
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = GridIndex(cell_size=cell_size, metric="euclidean")
+    for i, point in enumerate(hospitals):
+        index.insert(i, point)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = [index.nearest(point)[0][1] for point in queries]
+    index_time = time.perf_counter() - start
+
+    click.echo(json.dumps({
+        "hospitals": n_hospitals,
+        "queries": n_queries,
+        "scan_ms_per_query": 1000 * scan_time / n_queries,
+        "index_build_ms": 1000 * build_time,
+        "index_ms_per_query": 1000 * index_time / n_queries,
+        "speedup": scan_time / index_time,
+        "same_results": scanned == indexed,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
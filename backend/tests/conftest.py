@@ -25,7 +25,12 @@ def test_client():
 
 @pytest.fixture
 def db_session(db):
+    from wirvsvirus.api import matching, propositions
+    from wirvsvirus.auth import profile_cache
     db.db.client.drop_database(db.get_database())
+    profile_cache.clear()
+    matching.reset()
+    propositions.reset()
     return db
 
 @pytest.fixture
@@ -1,3 +1,4 @@
+import json
 import uuid
 import datetime
 
@@ -104,6 +105,18 @@ def test_simple_hospital_crud_roundtrip(test_client, db_session, mock_auth):
     assert query_response.json() == {'data': {'hospital': {'name': 'test', 'id': created_id}}}
 
 
+def test_hospital_batch_create(test_client, db_session, mock_auth):
+    """Test that hospitals can be created in a single request."""
+    response = test_client.post('/hospitals/batch', json=[{'name': 'first', 'address': 'test'},
+                                                          {'name': 'second', 'address': 'test'}])
+    assert response.status_code == 200
+    assert [h['name'] for h in response.json()] == ['first', 'second']
+    ids = {h['id'] for h in response.json()}
+    assert len(ids) == 2
+    query_response = test_client.post('/graphql', json={'query': 'query {hospitals {id}}'})
+    assert {h['id'] for h in query_response.json()['data']['hospitals']} == ids
+
+
 def test_auth(auth_token, test_client, db_session):
     """Test authentication validation.
 
@@ -126,6 +139,34 @@ def test_hospitals_graphql_roundtrip(test_client, db_session, mock_auth):
 
 
 
+def test_hospitals_graphql_pagination(test_client, db_session, mock_auth):
+    """Test cursor pagination and filtering of hospitals."""
+    created_ids = []
+    for i, state in enumerate(['Berlin', 'Hessen', 'Berlin']):
+        item = models.HospitalBase(name=f'test {i}', address='test', address_state=state,
+                                   location=models.Location(type='Point', coordinates=(7 + i, 50)))
+        response = test_client.post('/hospitals', data=item.json())
+        assert response.status_code == 200
+        created_ids.append(response.json()['id'])
+
+    query = 'query {hospitalsConnection(first: 2 AFTER) {edges {node {id}} pageInfo {hasNextPage endCursor}}}'
+    response = test_client.post('/graphql', json={'query': query.replace('AFTER', '')}).json()
+    connection = response['data']['hospitalsConnection']
+    assert [e['node']['id'] for e in connection['edges']] == created_ids[:2]
+    assert connection['pageInfo']['hasNextPage']
+
+    after = ', after: "%s"' % connection['pageInfo']['endCursor']
+    response = test_client.post('/graphql', json={'query': query.replace('AFTER', after)}).json()
+    connection = response['data']['hospitalsConnection']
+    assert [e['node']['id'] for e in connection['edges']] == created_ids[2:]
+    assert not connection['pageInfo']['hasNextPage']
+
+    response = test_client.post('/graphql', json={'query': 'query {hospitals(state: "Berlin") {id}}'}).json()
+    assert [h['id'] for h in response['data']['hospitals']] == [created_ids[0], created_ids[2]]
+    response = test_client.post('/graphql', json={'query': 'query {hospitals(bbox: [7.5, 49, 8.5, 51]) {id}}'}).json()
+    assert [h['id'] for h in response['data']['hospitals']] == [created_ids[1]]
+
+
 def test_nested_hospitals_crud_roundtrip(test_client, db_session, mock_auth):
     """Test that creating and querying hospitals works."""
     item = models.HospitalBase(name='test', address='test')
@@ -186,3 +227,90 @@ def test_nested_hospitals_crud_roundtrip(test_client, db_session, mock_auth):
             }
         }
     }
+
+
+def test_nearest_hospitals(test_client, db_session, mock_auth):
+    """Test finding the nearest hospitals to a position."""
+    for name, coordinates in [('cologne', (6.9, 50.9)), ('berlin', (13.4, 52.5)), ('frankfurt', (8.7, 50.1))]:
+        item = models.HospitalBase(name=name, address='test', location=models.Location(type='Point', coordinates=coordinates))
+        response = test_client.post('/hospitals', data=item.json())
+        assert response.status_code == 200
+    # the startup event isn't triggered by the test client, so create indexes here
+    asyncio.get_event_loop().run_until_complete(db.ensure_indexes())
+
+    response = test_client.post('/nearest_hospital', params={'lon': 7.1, 'lat': 51.2, 'k': 2})
+    assert response.status_code == 200
+    assert [h['name'] for h in response.json()] == ['cologne', 'frankfurt']
+    assert response.json()[0]['distance'] < 50000
+
+    response = test_client.post('/nearest_hospital', params={'lon': 7.1, 'lat': 51.2, 'k': 3, 'max_distance': 50000})
+    assert [h['name'] for h in response.json()] == ['cologne']
+
+
+def test_graphql_batches_nested_queries(test_client, mock_auth, mocker):
+    """Test that nested resolvers batch their queries per request."""
+    hospitals = [{'_id': ObjectId(), 'name': f'hospital {i}', 'address': 'test'} for i in range(3)]
+    helper = {'_id': ObjectId(), **dummy_helper.dict()}
+    requirements = [
+        {'_id': ObjectId(), 'hospital_id': str(h['_id']), 'activity_id': 'hotline', 'value': 1}
+        for h in hospitals for _ in range(2)
+    ]
+    matches = [
+        {**dummy_match.dict(), '_id': ObjectId(), 'personnel_requirement_id': str(r['_id']), 'helper_id': str(helper['_id'])}
+        for r in requirements
+    ]
+    collections = {'hospitals': hospitals, 'helpers': [helper],
+                   'personnel_requirements': requirements, 'matches': matches}
+
+    async def find(collection, query, projection=None, **kwargs):
+        if not query:
+            return collections[collection]
+        [(field, condition)] = query.items()
+        return [d for d in collections[collection] if d.get(field) in condition['$in']]
+
+    find_mock = mocker.patch('wirvsvirus.crud.find', side_effect=find)
+    response = test_client.post('/graphql', json={
+        'query': 'query {hospitals {id personnelRequirements {id} matches {id helper {id}}}}'
+    })
+    data = response.json()['data']['hospitals']
+    assert len(data) == 3
+    assert all(len(h['matches']) == 2 for h in data)
+    assert all(m['helper']['id'] == str(helper['_id']) for h in data for m in h['matches'])
+    # hospitals, requirements, matches and helpers are each loaded once
+    assert find_mock.call_count == 4
+
+
+def test_graphql_hospitals_projection(test_client, mock_auth, mocker):
+    """Test that only the fields selected in the query are fetched."""
+    hospital = {'_id': ObjectId(), 'name': 'test', 'address': 'test', 'address_state': 'Berlin'}
+
+    async def find(collection, query, projection=None, **kwargs):
+        return [{k: v for k, v in hospital.items() if projection is None or k in projection}]
+
+    find_mock = mocker.patch('wirvsvirus.crud.find', side_effect=find)
+    response = test_client.post('/graphql', json={'query': 'query {hospitals {id name addressState}}'})
+    assert response.json()['data']['hospitals'] == [{'id': str(hospital['_id']), 'name': 'test', 'addressState': 'Berlin'}]
+    assert find_mock.call_args[0][2] == {'_id': 1, 'name': 1, 'address_state': 1}
+
+    response = test_client.post('/graphql', json={'query': 'query {hospitalsConnection {edges {node {name}}}}'})
+    assert response.json()['data']['hospitalsConnection']['edges'] == [{'node': {'name': 'test'}}]
+    assert find_mock.call_args[0][2] == {'_id': 1, 'name': 1}
+
+    # fragments aren't resolved, so all fields are fetched
+    response = test_client.post('/graphql', json={
+        'query': 'query {hospitals {...fields}} fragment fields on Hospital {name}'
+    })
+    assert response.json()['data']['hospitals'] == [{'name': 'test'}]
+    assert find_mock.call_args[0][2] is None
+
+
+def test_export_hospitals(test_client, db_session, mock_auth):
+    """Test that hospitals are exported as newline delimited JSON."""
+    for name in ['first', 'second']:
+        test_client.post('/hospitals', json={'name': name, 'address': 'test'})
+    response = test_client.get('/hospitals/export')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line['name'] for line in lines] == ['first', 'second']
+    assert all(line['id'] for line in lines)
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from authlib.jose import JsonWebKey, jwt
+from fastapi import HTTPException
+
+from wirvsvirus.auth import JWKS, Auth, JWKSManager, ProfileCache, TokenCache, UserInfoClient, jwks_from_file
+from wirvsvirus.settings import settings
+
+
+@pytest.fixture(scope="module")
+def private_key():
+    return JsonWebKey.generate_key('RSA', 2048, is_private=True, options={'kid': 'test-key'})
+
+
+@pytest.fixture
+def key_set(private_key, tmp_path):
+    path = tmp_path / 'jwks.json'
+    path.write_text(json.dumps({'keys': [private_key.as_dict(is_private=False)]}))
+    return JWKSManager(jwks_from_file(path))
+
+
+@pytest.fixture
+def test_auth(key_set):
+    return Auth(key_set=key_set)
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def make_token(private_key, expires_in=60):
+    payload = {'sub': 'user', 'iss': settings.auth_issuer, 'exp': int(time.time()) + expires_in}
+    return jwt.encode({'alg': 'RS256'}, payload, private_key).decode()
+
+
+def test_decode_caches_verified_tokens(test_auth, key_set, private_key, mocker):
+    """Test that a token's signature is only verified once."""
+    run(key_set.refresh())
+    decode = mocker.spy(jwt, 'decode')
+    token = make_token(private_key)
+    assert run(test_auth.decode_jwt(token))['sub'] == 'user'
+    assert run(test_auth.decode_jwt(token))['sub'] == 'user'
+    assert decode.call_count == 1
+
+
+def test_decode_rejects_unknown_key_id(test_auth):
+    """Test that tokens signed with an unknown key are rejected."""
+    other_key = JsonWebKey.generate_key('RSA', 2048, is_private=True, options={'kid': 'other-key'})
+    with pytest.raises(HTTPException) as e:
+        run(test_auth.decode_jwt(make_token(other_key)))
+    assert e.value.status_code == 401
+
+
+def test_unknown_key_id_refetches_keys(test_auth, key_set, private_key):
+    """Test that rotated keys are fetched when a token uses an unknown key id."""
+    run(key_set.start())
+    rotated_key = JsonWebKey.generate_key('RSA', 2048, is_private=True, options={'kid': 'rotated-key'})
+    keys = [private_key.as_dict(is_private=False), rotated_key.as_dict(is_private=False)]
+
+    async def source():
+        return JWKS(keys=keys)
+
+    key_set.source = source
+    # the keys were just fetched, so they aren't fetched again immediately
+    with pytest.raises(HTTPException):
+        run(test_auth.decode_jwt(make_token(rotated_key)))
+    key_set.attempted_at -= key_set.min_refetch_interval
+    assert run(test_auth.decode_jwt(make_token(rotated_key)))['sub'] == 'user'
+    assert set(key_set.keys) == {'test-key', 'rotated-key'}
+    run(key_set.stop())
+
+
+def test_token_cache_expiry_and_size():
+    """Test that cached tokens expire with the token and the oldest entries are evicted."""
+    cache = TokenCache(maxsize=2)
+    cache.set('expired', {'exp': time.time() - 1})
+    assert cache.get('expired') is None
+    for token in ['a', 'b', 'c']:
+        cache.set(token, {'exp': time.time() + 60})
+    assert cache.get('a') is None
+    assert cache.get('c') == {'exp': pytest.approx(time.time() + 60, abs=5)}
+
+
+@pytest.fixture
+def identity_server():
+    """Local stub of the identity provider's userinfo endpoint."""
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.headers['Authorization'])
+            time.sleep(0.1)
+            body = json.dumps({'email': 'me@example.com', 'email_verified': True}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/userinfo', requests
+    server.shutdown()
+
+
+def test_user_info_is_coalesced_and_cached(identity_server):
+    """Test that concurrent and repeated user info lookups make a single request."""
+    url, requests = identity_server
+    client = UserInfoClient(url, ttl=60)
+
+    async def lookup():
+        results = await asyncio.gather(*(client.get('user', 'token') for _ in range(5)))
+        results.append(await client.get('user', 'token'))
+        await client.close()
+        return results
+
+    results = asyncio.get_event_loop().run_until_complete(lookup())
+    assert all(result['email'] == 'me@example.com' for result in results)
+    assert requests == ['Bearer token']
+
+
+def test_profile_cache(mocker):
+    """Test that profiles are cached and missing profiles only briefly."""
+    profiles = {'known': {'user_id': 'known', 'email': 'me@example.com', 'profile_type': 'helper'}}
+
+    async def find_one(query):
+        return profiles.get(query['user_id'])
+
+    database = mocker.patch('wirvsvirus.db.get_database').return_value
+    database.profiles.find_one.side_effect = find_one
+    cache = ProfileCache(negative_ttl=60)
+
+    assert run(cache.get('known'))['email'] == 'me@example.com'
+    assert run(cache.get('known'))['email'] == 'me@example.com'
+    assert run(cache.get('unknown')) is None
+    assert run(cache.get('unknown')) is None
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'size': 2}
+
+    cache.negative_ttl = 0
+    cache.set('unknown', None)
+    profiles['unknown'] = {'user_id': 'unknown'}
+    assert run(cache.get('unknown')) == {'user_id': 'unknown'}
+    assert database.profiles.find_one.call_count == 3
+
+    # bare profiles are completed later, so they expire like missing ones
+    profiles['unknown']['profile_type'] = 'helper'
+    assert run(cache.get('unknown'))['profile_type'] == 'helper'
+    assert run(cache.get('known'))['profile_type'] == 'helper'
+    assert database.profiles.find_one.call_count == 4
+
+
+def test_current_profile_creates_bare_profile(identity_server, db_session, monkeypatch):
+    """Test that the first login creates a bare profile with the verified email."""
+    from fastapi.security import HTTPAuthorizationCredentials
+    from wirvsvirus import auth
+
+    url, requests = identity_server
+    monkeypatch.setattr(auth, 'user_info_client', UserInfoClient(url))
+    credentials = HTTPAuthorizationCredentials(scheme='Bearer', credentials='token')
+
+    profile = run(auth.current_profile(credentials, {'sub': 'new-user'}))
+    assert (profile.user_id, profile.email, profile.profile_type) == ('new-user', 'me@example.com', None)
+    assert profile.id
+    # the second login finds the stored profile
+    assert run(auth.current_profile(credentials, {'sub': 'new-user'})).id == profile.id
+    assert requests == ['Bearer token']
+    assert run(db_session.get_database().profiles.count_documents({'user_id': 'new-user'})) == 1
+    run(auth.user_info_client.close())
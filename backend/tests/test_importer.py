@@ -0,0 +1,65 @@
+import asyncio
+import csv
+
+from wirvsvirus import importer_csv
+
+FIELDS = ['X', 'Y', 'name', 'address_full', 'contact_website', 'contact_phone', 'operator', 'operator_type',
+          'contact_email', 'contact_fax', 'addr', 'address_street', 'address_housenumber', 'address_city',
+          'address_suburb', 'address_subdistrict', 'address_district', 'address_province', 'address_state',
+          'denomination', 'religion', 'emergency', 'rooms', 'beds', 'capacity', 'wheelchair', 'wikidata',
+          'wikipedia', 'ORIG_FID', 'GlobalID']
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({field: row.get(field, '') for field in FIELDS})
+
+
+def test_import_is_idempotent(db_session, tmp_path):
+    """Test that re-importing hospitals updates them instead of creating duplicates."""
+    path = tmp_path / 'clinics.csv'
+    rows = [{'X': 6.9 + i, 'Y': 50.9, 'name': f'clinic {i}', 'address_full': 'test', 'GlobalID': f'{{id-{i}}}'}
+            for i in range(5)]
+    write_csv(path, rows)
+    loop = asyncio.get_event_loop()
+
+    stats = loop.run_until_complete(importer_csv.get_data_from_arcgis_file(path, batch_size=2))
+    assert (stats['rows'], stats['inserted']) == (5, 5)
+    hospitals = db_session.get_database().hospitals
+    loop.run_until_complete(hospitals.update_one({'_id': importer_csv.hospital_id('{id-0}')},
+                                                 {'$set': {'personnel_requirement_ids': ['requirement']}}))
+
+    rows[1]['name'] = 'renamed'
+    write_csv(path, rows)
+    stats = loop.run_until_complete(importer_csv.get_data_from_arcgis_file(path, batch_size=2))
+    assert (stats['rows'], stats['inserted'], stats['updated']) == (5, 0, 1)
+    assert loop.run_until_complete(hospitals.count_documents({})) == 5
+    first = loop.run_until_complete(hospitals.find_one({'_id': importer_csv.hospital_id('{id-0}')}))
+    assert first['personnel_requirement_ids'] == ['requirement']
+    second = loop.run_until_complete(hospitals.find_one({'_id': importer_csv.hospital_id('{id-1}')}))
+    assert second['name'] == 'renamed'
+
+
+def test_import_rejects_invalid_rows(db_session, tmp_path):
+    """Test that invalid helper rows are written to the rejects file."""
+    path = tmp_path / 'helpers.csv'
+    rejects = tmp_path / 'rejects.csv'
+    path.write_text('first_name,last_name,email,qualification_id,work_experience_in_years,activity_ids\n'
+                    'Ada,Lovelace,ada@example.com,doctor,3,icu;er\n'
+                    'Bad,Row,bad@example.com,nurse,many,\n'
+                    'Alan,Turing,alan@example.com,nurse,1,\n')
+
+    stats = asyncio.get_event_loop().run_until_complete(importer_csv.import_csv(
+        path, 'helpers', importer_csv.upsert_helper, batch_size=2, workers=2, rejects_file=rejects))
+    assert (stats['rows'], stats['inserted'], stats['rejected']) == (3, 2, 1)
+
+    helpers = db_session.get_database().helpers
+    ada = asyncio.get_event_loop().run_until_complete(helpers.find_one({'email': 'ada@example.com'}))
+    assert ada['activity_ids'] == ['icu', 'er']
+    with open(rejects, newline='') as f:
+        [rejected] = list(csv.DictReader(f))
+    assert rejected['email'] == 'bad@example.com'
+    assert 'workExperienceInYears' in rejected['error']
@@ -0,0 +1,28 @@
+import asyncio
+from unittest import mock
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel
+
+from wirvsvirus import db, models
+
+
+def test_ensure_indexes(db_session):
+    """Test that all registered indexes are created and reported."""
+    loop = asyncio.get_event_loop()
+    assert {e['status'] for e in loop.run_until_complete(db_session.index_report())} == {'missing'}
+
+    loop.run_until_complete(db_session.ensure_indexes())
+    report = loop.run_until_complete(db_session.index_report())
+    assert len(report) == sum(len(indexes) for indexes in models.INDEXES.values())
+    assert 'missing' not in {e['status'] for e in report}
+    assert 'unregistered' not in {e['status'] for e in report}
+
+
+def test_ensure_indexes_without_database(caplog):
+    """Test that a missing database doesn't stop the startup."""
+    client = AsyncIOMotorClient('mongodb://127.0.0.1:1/default', serverSelectionTimeoutMS=100)
+    indexes = {'helpers': [IndexModel('email', name='email')], 'hospitals': [IndexModel('name', name='name')]}
+    with mock.patch.object(db.db, 'database', client.get_default_database()):
+        asyncio.get_event_loop().run_until_complete(db.ensure_indexes(indexes))
+    assert ['the database is not available' in r.message for r in caplog.records] == [True]
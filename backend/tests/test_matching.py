@@ -1,6 +1,13 @@
 """Test matching algorithm."""
 
-from wirvsvirus.matching import MatchingModel
+import asyncio
+import copy
+import random
+
+import numpy as np
+
+from wirvsvirus.matching import (IncrementalMatching, MatchingModel, PartitionedMatchingModel, create_executor,
+                                 nearest_positions)
 from wirvsvirus.models import (
     HelperBase,
     HospitalBase,
@@ -161,6 +168,8 @@ def test_matching():
     results = model.results
     assert results == {
         "objective": 1033.0,
+        "bound": 1033.0,
+        "status": "OPTIMAL",
         "allocations": [
             {
                 "hospital_id": "Hospital Cologne",
@@ -175,6 +184,223 @@ def test_matching():
     }
 
 
+def test_matching_solver_parameters():
+    """Test solving with a time limit, worker count and gap target."""
+    model = MatchingModel(
+        hospitals=example_problem["hospitals"], worker=example_problem["worker"],
+        max_time=10, num_workers=1, relative_gap=0.5,
+    )
+    model.solve()
+    assert model.solver.parameters.max_time_in_seconds == 10
+    assert model.results["status"] in ("OPTIMAL", "FEASIBLE")
+    assert model.results["objective"] <= model.results["bound"]
+    assert model.progress.solutions[-1]["objective"] == model.results["objective"]
+
+
+def test_sparse_matching():
+    """Test that the sparse model finds the same solution with fewer edges."""
+    model = MatchingModel(
+        hospitals=example_problem["hospitals"], worker=example_problem["worker"],
+        sparse=True,
+    )
+    assert len(model.edges) < len(example_problem["hospitals"]) * len(example_problem["worker"])
+    model.solve()
+    dense_model = MatchingModel(
+        hospitals=example_problem["hospitals"], worker=example_problem["worker"]
+    )
+    dense_model.solve()
+    assert model.results == dense_model.results
+
+
+def test_sparse_matching_candidate_edges():
+    """Test that the sparse model only calculates distances for candidate edges."""
+    dense_model = MatchingModel(hospitals=example_problem["hospitals"], worker=example_problem["worker"])
+    model = MatchingModel(hospitals=example_problem["hospitals"], worker=example_problem["worker"], sparse=True)
+    assert list(model.distances) == model.edges
+    for i, j in model.edges:
+        assert model.distances[i, j] == dense_model.distances[i, j]
+    distances, edges = model.find_candidate_edges(chunk_size=1)
+    assert distances == model.distances
+    assert edges == model.edges
+
+
+def test_sparse_matching_max_distance():
+    """Test that helpers outside the radius are not allocated."""
+    model = MatchingModel(
+        hospitals=example_problem["hospitals"], worker=example_problem["worker"],
+        sparse=True, max_distance=20,
+    )
+    model.solve()
+    for i, j in model.edges:
+        assert model.distances[i, j] <= 20
+    assert model.results["objective"] == 826.0
+
+
+def test_min_cost_flow_matching():
+    """Test that the min cost flow engine finds the CP-SAT optimum."""
+    cp_sat_model = MatchingModel(
+        hospitals=example_problem["hospitals"], worker=example_problem["worker"]
+    )
+    cp_sat_model.solve()
+    for sparse in (False, True):
+        model = MatchingModel(
+            hospitals=example_problem["hospitals"], worker=example_problem["worker"],
+            sparse=sparse, engine="min_cost_flow",
+        )
+        model.solve()
+        assert model.results == cp_sat_model.results
+
+
+def test_engines_agree_for_multi_skill_helpers():
+    """Test that a helper with several skills only fills the demand of one of them."""
+    hospitals = [{"_id": "h", "location": {"coordinates": [0, 0]}, "demand": {"medical": 1, "logistic": 1}}]
+    worker = [
+        {"_id": "both", "location": {"coordinates": [0, 0.1]}, "activity_ids": ["medical", "logistic"]},
+        {"_id": "logistic", "location": {"coordinates": [0, 0.2]}, "activity_ids": ["logistic"]},
+    ]
+    results = []
+    for engine in MatchingModel.engines:
+        model = MatchingModel(hospitals=hospitals, worker=worker, engine=engine)
+        model.solve()
+        results.append(model.results)
+    assert results[0] == results[1]
+    assert results[0]["objective"] == 197
+    assert results[0]["allocations"] == [{"hospital_id": "h", "helper_ids": ["both", "logistic"]}]
+
+    rng = random.Random(0)
+    skills = ["medical", "logistic", "admin"]
+    hospitals = [{"_id": f"h{i}", "location": {"coordinates": [rng.uniform(0, 5), rng.uniform(0, 5)]},
+                  "demand": {skill: rng.randint(0, 3) for skill in skills}} for i in range(20)]
+    worker = [{"_id": f"w{j}", "location": {"coordinates": [rng.uniform(0, 5), rng.uniform(0, 5)]},
+               "activity_ids": rng.sample(skills, rng.randint(1, 3))} for j in range(100)]
+    objectives = []
+    for engine in MatchingModel.engines:
+        model = MatchingModel(hospitals=hospitals, worker=worker, sparse=True, engine=engine)
+        model.solve()
+        assert model.results["status"] == "OPTIMAL"
+        objectives.append(model.results["objective"])
+    assert objectives[0] == objectives[1]
+
+
+def test_partitioned_matching():
+    """Test solving regional partitions in parallel."""
+    model = PartitionedMatchingModel(
+        hospitals=example_problem["hospitals"], worker=example_problem["worker"],
+        cell_size=100, max_workers=2,
+    )
+    assert len(model.partitions) == 1
+    model.solve()
+    global_model = MatchingModel(
+        hospitals=example_problem["hospitals"], worker=example_problem["worker"]
+    )
+    global_model.solve()
+    assert model.results == global_model.results
+
+    with create_executor(max_workers=2) as executor:
+        model = PartitionedMatchingModel(
+            hospitals=example_problem["hospitals"], worker=example_problem["worker"],
+            cell_size=1, executor=executor, sparse=True,
+        )
+        assert len(model.partitions) == 3
+        model.solve()
+    assert [a["hospital_id"] for a in model.results["allocations"]] == [
+        "Hospital Cologne", "Hospital Berlin", "Hospital Frankfurt"
+    ]
+    helper_ids = [i for a in model.results["allocations"] for i in a["helper_ids"]]
+    assert len(helper_ids) == len(set(helper_ids))
+    # the border round fills Cologne with the surplus helpers near Frankfurt, the global optimum is 1033
+    assert model.results["objective"] == 1032.0
+
+
+def test_incremental_matching():
+    """Test that re-solving only the changed neighbourhood finds the global optimum."""
+    problem = copy.deepcopy(example_problem)
+    matching = IncrementalMatching(neighbourhood=30)
+    assert matching.needs_reload()
+    matching.track_changes()
+    matching.load(problem["hospitals"], problem["worker"])
+    assert not matching.needs_reload() and not matching.needs_reload(max_age=60)
+    assert matching.needs_reload(max_age=-1)
+    matching.solve()
+    assert matching.results["objective"] == 1033.0
+
+    def solve_globally():
+        model = MatchingModel(hospitals=matching.hospitals, worker=matching.worker)
+        model.solve()
+        return model.results
+
+    matching.add_helper({
+        "_id": "15",
+        "activity_ids": ["medical"],
+        "location": {"type": "Point", "coordinates": [52.4, 13.3]},
+    })
+    matching.apply_changes()
+    # only Berlin, its helper and the new helper are affected
+    assert matching.affected() == ([1], [3, 12, 14])
+    matching.solve()
+    assert matching.results["allocations"][1]["helper_ids"] == ["4", "15"]
+    assert matching.results == solve_globally()
+
+    matching.update_demand("Hospital Cologne", {"admin": 1, "medical": 0, "logistic": 3})
+    matching.solve()
+    assert matching.results == solve_globally()
+
+    matching.update_demand("unknown hospital", {"admin": 1})
+    matching.apply_changes()
+    assert matching.affected() == ([], [])
+
+
+def test_incremental_matching_keeps_allocations_without_solution(caplog):
+    """Test that a re-solve without a solution keeps the previous allocations."""
+    problem = copy.deepcopy(example_problem)
+    matching = IncrementalMatching(neighbourhood=30)
+    matching.track_changes()
+    matching.load(problem["hospitals"], problem["worker"])
+    matching.solve()
+    previous = matching.results
+
+    # too short to find any solution
+    matching.model_options["max_time"] = 1e-9
+    matching.update_demand("Hospital Cologne", {"admin": 1, "medical": 0, "logistic": 3})
+    matching.solve()
+    assert matching.results["status"] == "UNKNOWN"
+    assert matching.results["allocations"] == previous["allocations"]
+    assert matching.results["objective"] == previous["objective"]
+    assert matching.results["bound"] is None
+    assert "keeping the previous allocations" in caplog.text
+
+    # the change is re-solved with the next solve
+    del matching.model_options["max_time"]
+    matching.solve()
+    assert matching.results["status"] == "OPTIMAL"
+    model = MatchingModel(hospitals=matching.hospitals, worker=matching.worker)
+    model.solve()
+    assert matching.results == model.results
+
+
+def test_haversine_distances():
+    """Test great-circle distances in km between (lon, lat) points."""
+    hospitals = [
+        {**h, "location": {"type": "Point", "coordinates": [h["longitude"], h["latitude"]]}}
+        for h in example_problem["hospitals"]
+    ]
+    model = MatchingModel(hospitals=hospitals, worker=[], metric="haversine")
+    assert model.distances.shape == (3, 0)
+    worker = [{**h, "activity_ids": []} for h in hospitals[1:]]
+    model = MatchingModel(hospitals=hospitals[:1], worker=worker, metric="haversine")
+    # Cologne - Berlin and Cologne - Frankfurt
+    assert model.distances.tolist() == [[481, 155]]
+
+
+def test_nearest_positions():
+    """Test that the nearest points are found with the given metric."""
+    # a degree of longitude is only about 56km at latitude 60
+    coords_from = np.array([[0.0, 60.0]])
+    coords_to = np.array([[1.5, 60.0], [0.0, 61.0]])
+    assert nearest_positions(coords_from, coords_to) == [1]
+    assert nearest_positions(coords_from, coords_to, "haversine") == [0]
+
+
 def test_propose_matching_endpoint(test_client, db_session, mock_auth):
     """Test propose matching endpoint."""
 
@@ -222,3 +448,61 @@ def test_propose_matching_endpoint(test_client, db_session, mock_auth):
     assert "allocations" in response
     assert "hospitalId" in response["allocations"][0]
     assert "helperIds" in response["allocations"][0]
+
+
+def test_propose_matching_sums_demand(test_client, db_session, mock_auth):
+    """Test that requirements are summed and hospitals without demand are left out."""
+    hospital_ids = []
+    for name in ("with demand", "without demand"):
+        hospital = HospitalBase(
+            name=name, address="",
+            location=Location(type="Point", coordinates=(6.9, 50.9)),
+        )
+        response = test_client.post("/hospitals", data=hospital.json())
+        response.raise_for_status()
+        hospital_ids.append(response.json()["id"])
+    for _ in range(2):
+        requirement = PersonnelRequirementBase(
+            hospital_id=hospital_ids[0], activity_id="medical", value=1
+        )
+        response = test_client.post("/personnel_requirements", data=requirement.json())
+        response.raise_for_status()
+    for _ in range(3):
+        helper = HelperBase(
+            first_name="foo", last_name="bar", email="",
+            location=Location(type="Point", coordinates=(7.0, 51.0)),
+            qualification_id="", work_experience_in_years=1,
+            activity_ids=["medical"],
+        )
+        response = test_client.post("/helpers", data=helper.json())
+        response.raise_for_status()
+
+    response = test_client.get("/matches/propositions")
+    assert response.status_code == 200
+    allocations = response.json()["allocations"]
+    assert [a["hospitalId"] for a in allocations] == [hospital_ids[0]]
+    assert len(allocations[0]["helperIds"]) == 2
+
+
+def test_propose_matching_without_location(test_client, db_session, mock_auth):
+    """Test that hospitals and helpers without a location are left out."""
+    hospital_ids = []
+    for location in (Location(type="Point", coordinates=(6.9, 50.9)), None):
+        response = test_client.post("/hospitals", data=HospitalBase(name="test", address="", location=location).json())
+        response.raise_for_status()
+        hospital_ids.append(response.json()["id"])
+        requirement = PersonnelRequirementBase(hospital_id=hospital_ids[-1], activity_id="medical", value=1)
+        test_client.post("/personnel_requirements", data=requirement.json()).raise_for_status()
+    # e.g. imported from a CSV row without coordinates
+    helper = HelperBase(first_name="foo", last_name="bar", email="", qualification_id="", work_experience_in_years=1,
+                        activity_ids=["medical"])
+    asyncio.get_event_loop().run_until_complete(
+        db_session.get_database().helpers.insert_one({**helper.dict(), "location": None}))
+    helper.location = Location(type="Point", coordinates=(7.0, 51.0))
+    test_client.post("/helpers", data=helper.json()).raise_for_status()
+
+    response = test_client.get("/matches/propositions")
+    assert response.status_code == 200
+    allocations = response.json()["allocations"]
+    assert [a["hospitalId"] for a in allocations] == [hospital_ids[0]]
+    assert len(allocations[0]["helperIds"]) == 1
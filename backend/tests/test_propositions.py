@@ -0,0 +1,54 @@
+"""Test cached match propositions."""
+
+import asyncio
+
+from wirvsvirus.propositions import PropositionCache
+
+
+def test_debounced_recomputation():
+    """Test that a burst of changes results in a single recomputation."""
+    calls = []
+
+    async def compute():
+        calls.append(cache.data_version)
+        return {"allocations": []}
+
+    cache = PropositionCache(compute, debounce=0.05)
+
+    async def scenario():
+        first = await cache.get()
+        assert first["data_version"] == 0 and not first["stale"]
+        for _ in range(5):
+            cache.invalidate()
+        stale = await cache.get()
+        assert stale["data_version"] == 0 and stale["stale"]
+        await asyncio.sleep(0.2)
+        fresh = await cache.get()
+        assert fresh["data_version"] == 5 and not fresh["stale"]
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+    assert calls == [0, 5]
+
+
+def test_recompute_expired_propositions():
+    """Test that propositions older than max_age are recomputed on the next get."""
+    calls = []
+
+    async def compute():
+        calls.append(cache.data_version)
+        return {"allocations": []}
+
+    cache = PropositionCache(compute, debounce=0.01, max_age=0.1)
+
+    async def scenario():
+        await cache.get()
+        await cache.get()
+        await asyncio.sleep(0.15)
+        expired = await cache.get()
+        assert expired["data_version"] == 0 and expired["stale"]
+        await asyncio.sleep(0.05)
+        fresh = await cache.get()
+        assert fresh["data_version"] == 1 and not fresh["stale"]
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+    assert calls == [0, 1]
@@ -0,0 +1,35 @@
+"""Test the in-memory spatial index."""
+
+import random
+
+import pytest
+
+from wirvsvirus.spatial import GridIndex
+
+
+@pytest.mark.parametrize("metric,radius", [("euclidean", 0.3), ("haversine", 30)])
+def test_grid_index_matches_linear_scan(metric, radius):
+    """Test nearest and radius searches against a linear scan."""
+    random.seed(0)
+    points = [(random.uniform(5.9, 15), random.uniform(47.3, 55)) for _ in range(500)]
+    index = GridIndex(cell_size=0.2, metric=metric)
+    for i, point in enumerate(points):
+        index.insert(i, point)
+    assert len(index) == 500
+
+    for _ in range(50):
+        query = (random.uniform(5, 16), random.uniform(46, 56))
+        scan = sorted((index.distance(*query, *point), i) for i, point in enumerate(points))
+        assert index.nearest(query, k=3) == scan[:3]
+        assert sorted(index.within(query, radius)) == [(d, i) for d, i in scan if d <= radius]
+        assert index.nearest(query, k=3, max_distance=radius) == [(d, i) for d, i in scan[:3] if d <= radius]
+
+
+def test_grid_index_haversine_distance():
+    """Test great-circle distance in km between Cologne and Berlin."""
+    index = GridIndex()
+    index.insert("berlin", (13.4, 52.5))
+    [(distance, key)] = index.nearest((6.9, 50.9))
+    assert key == "berlin"
+    assert int(distance) == 481
+    assert GridIndex().nearest((6.9, 50.9)) == []
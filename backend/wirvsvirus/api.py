@@ -1,18 +1,25 @@
 """Setup an API."""
 
+import asyncio
 from typing import List, Any
 from datetime import datetime, timedelta
 from uuid import UUID
 from math import sqrt
 import logging
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from wirvsvirus import db, models, auth, crud
 from wirvsvirus.graphql import graphql_app
-from wirvsvirus.matching import MatchingModel
+from wirvsvirus.matching import IncrementalMatching, create_executor
+from wirvsvirus.propositions import PropositionCache
+from wirvsvirus.spatial import GridIndex
+from wirvsvirus.settings import settings
 
 
 app = FastAPI(
@@ -20,7 +27,11 @@ app = FastAPI(
 )
 
 app.add_event_handler("startup", db.connect)
+app.add_event_handler("startup", db.ensure_indexes)
+app.add_event_handler("startup", auth.jwks_manager.start)
 app.add_event_handler("shutdown", db.disconnect)
+app.add_event_handler("shutdown", auth.jwks_manager.stop)
+app.add_event_handler("shutdown", auth.user_info_client.close)
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,8 +41,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+matching = IncrementalMatching(
+    neighbourhood=settings.matching_neighbourhood,
+    partition_options=dict(
+        cell_size=settings.matching_partition_cell_size,
+        max_workers=settings.matching_partition_workers
+    ) if settings.matching_partitioned else None,
+    sparse=settings.matching_sparse, max_distance=settings.matching_max_distance,
+    metric=settings.matching_metric, engine=settings.matching_engine,
+    max_time=settings.matching_max_time, num_workers=settings.matching_num_workers,
+    relative_gap=settings.matching_relative_gap
+)
+
+
+async def start_partition_executor():
+    """Start the process pool the matching partitions are solved in."""
+    if matching.partition_options is not None:
+        matching.partition_options['executor'] = create_executor(settings.matching_partition_workers)
+
+
+async def stop_partition_executor():
+    """Shut the partition process pool down."""
+    executor = (matching.partition_options or {}).pop('executor', None)
+    if executor is not None:
+        executor.shutdown()
+
+
+app.add_event_handler("startup", start_partition_executor)
+app.add_event_handler("shutdown", stop_partition_executor)
+
+
 @app.post('/profile', response_model=models.Profile)
-async def post_profile(profile: models.ProfileInput, db: db.AsyncIOMotorDatabase = Depends(db.get_database), jwt_payload: dict = Depends(auth.auth)):
+async def post_profile(profile: models.ProfileInput, db: db.AsyncIOMotorDatabase = Depends(db.get_database), jwt_payload: dict = Depends(auth.auth), db_profile: dict = Depends(auth.profile)):
     """Create your profile.
 
     This creates the currently authenticated users profile.
@@ -45,18 +86,20 @@ async def post_profile(profile: models.ProfileInput, db: db.AsyncIOMotorDatabase
     * If profileType is set to "hospital", the "hospitalId" field MUST be
       supplied and the corresponding hospital must exist.
 
-    WARNING: Once a profile is created it cannot be changed.
+    WARNING: Once a profile is created it cannot be changed. Only a bare
+    profile created on the first login is completed.
 
     """
     intermediate_profile = models.ProfileIntermediate(**profile.dict(), user_id=jwt_payload['sub'])
-    db_profile = await db.profiles.find_one({'user_id': intermediate_profile.user_id})
-    if db_profile:
+    if db_profile and db_profile.get('profile_type'):
         raise HTTPException(409, detail='profile already exists!')
 
     if profile.profile_type == models.ProfileTypeEnum.helper:
         if not profile.helper:
             raise HTTPException(400, "Missing helper definition for helper user profile.")
         document = await crud.create_item('helpers', profile.helper)
+        matching.add_helper(document)
+        propositions.invalidate()
         helper = models.Helper(**document)
         intermediate_profile.helper_id = helper.id
         intermediate_profile.hospital_id = None
@@ -71,13 +114,24 @@ async def post_profile(profile: models.ProfileInput, db: db.AsyncIOMotorDatabase
         raise NotImplementedError('profile type not implemented')
 
     # When everything else is done, finally create the profile
-    return await crud.create_item('profiles', intermediate_profile)
+    if db_profile:
+        document = await db.profiles.find_one_and_update(
+            {'_id': db_profile['_id'], 'profile_type': None}, {'$set': intermediate_profile.dict()},
+            return_document=ReturnDocument.AFTER)
+        if not document:
+            raise HTTPException(409, detail='profile already exists!')
+    else:
+        try:
+            document = await crud.create_item('profiles', intermediate_profile)
+        except DuplicateKeyError:
+            raise HTTPException(409, detail='profile already exists!')
+    auth.profile_cache.set(intermediate_profile.user_id, document)
+    return document
 
 @app.get('/profile', response_model=models.Profile)
-async def get_current_profile(db: db.AsyncIOMotorDatabase = Depends(db.get_database), jwt_payload: dict = Depends(auth.auth)):
+async def get_current_profile(profile: dict = Depends(auth.profile)):
     """Get current users profile"""
-    profile = await db.profiles.find_one({'user_id': jwt_payload['sub']})
-    if not profile:
+    if not profile or not profile.get('profile_type'):
         raise HTTPException(404, detail='No profile found')
     return profile
 
@@ -87,74 +141,173 @@ async def create_match(match: models.MatchBase, db: db.AsyncIOMotorDatabase = De
     return await crud.create_item('matches', match)
 
 
+async def load_demands(hospital_ids: List[str] = None, analytics: bool = False) -> dict:
+    """Load the personnel demand per hospital and activity in a single aggregation.
+
+    Returns a mapping of hospital id to a mapping of activity id to the summed
+    requirement values.
+    """
+    pipeline = [
+        {'$group': {
+            '_id': {'hospital_id': '$hospital_id', 'activity_id': '$activity_id'},
+            'value': {'$sum': '$value'}
+        }}
+    ]
+    if hospital_ids is not None:
+        pipeline.insert(0, {'$match': {'hospital_id': {'$in': hospital_ids}}})
+    demands = {}
+    database = db.get_analytics_database() if analytics else db.get_database()
+    async for group in database.personnel_requirements.aggregate(pipeline):
+        demands.setdefault(group['_id']['hospital_id'], {})[group['_id']['activity_id']] = group['value']
+    return demands
+
+
+async def compute_propositions() -> dict:
+    """Solve the matching, only re-solving changes if incremental.
+
+    The incremental model is reloaded from the database every
+    ``matching_reload_interval`` seconds to pick up writes it wasn't told about.
+    Hospitals and helpers without a location, e.g. imported without
+    coordinates, can't be matched and are left out.
+    """
+    if not settings.matching_incremental or matching.needs_reload(settings.matching_reload_interval):
+        # changes are tracked from here on, so they are applied even if the
+        # analytics reads below lag behind
+        matching.track_changes()
+        demands = await load_demands(analytics=True)
+        hospital_ids = [ObjectId(hospital_id) for hospital_id in demands if ObjectId.is_valid(hospital_id)]
+        hospitals = await crud.find("hospitals", {'_id': {'$in': hospital_ids}, 'location': {'$ne': None}},
+                                    {'name': 1, 'location': 1}, analytics=True)
+        for hospital in hospitals:
+            hospital.update({'demand': demands[str(hospital["_id"])]})
+        helpers = await crud.find("helpers", {'location': {'$ne': None}}, {'id': 1, 'location': 1, 'activity_ids': 1},
+                                  analytics=True)
+        matching.load(hospitals, helpers)
+    # solve in a thread so the event loop keeps serving requests
+    await asyncio.get_event_loop().run_in_executor(None, matching.solve)
+    return {key: matching.results[key] for key in ("allocations", "objective", "bound", "status")}
+
+
+propositions = PropositionCache(compute_propositions, debounce=settings.matching_debounce,
+                                max_age=settings.matching_reload_interval)
+app.add_event_handler("shutdown", propositions.reset)
+
+
 @app.get('/matches/propositions', response_model=models.MatchProposition)
 async def propose_matches(db: db.AsyncIOMotorDatabase = Depends(db.get_database), jwt_payload: dict = Depends(auth.auth)):
-    """Propose matches."""
-    hospitals = await crud.find("hospitals", {}, {'name': 1, 'location': 1})
-    for hospital in hospitals:
-        requirements = await crud.find("personnel_requirements", {"hospital_id": str(hospital["_id"])})
-        demand = {r["activity_id"]: r["value"] for r in requirements}
-        hospital.update({'demand': demand})
-    helpers = await crud.find("helpers", {}, {'id': 1, 'location': 1, 'activity_ids': 1})
-    model = MatchingModel(
-        hospitals=hospitals, worker=helpers
-    )
-    model.solve()
-    return {"allocations": model.results["allocations"]}
+    """Propose matches.
+
+    Propositions are served from a cache that is recomputed in the background
+    whenever helpers or personnel requirements are created. Hospitals only
+    take part once they have personnel requirements, so creating them doesn't
+    trigger a recomputation. "stale" is set if changes are not yet part of
+    the propositions.
+    """
+    return await propositions.get()
 
 
 @app.post('/personnel_requirements', response_model=models.PersonnelRequirement)
 async def create_personnel_requirements(personnel_requirement: models.PersonnelRequirementBase, db: db.AsyncIOMotorDatabase = Depends(db.get_database), jwt_payload: dict = Depends(auth.auth)):
     """Create new personnel requirement."""
-    return await crud.create_item('personnel_requirements', personnel_requirement)
+    document = await crud.create_item('personnel_requirements', personnel_requirement)
+    if matching.tracking and ObjectId.is_valid(personnel_requirement.hospital_id):
+        # the matching only knows hospitals with demand, so this may be a new one
+        hospital = await db.hospitals.find_one({'_id': ObjectId(personnel_requirement.hospital_id)}, {'name': 1, 'location': 1})
+        if hospital:
+            demands = await load_demands([personnel_requirement.hospital_id])
+            matching.add_hospital(hospital)
+            matching.update_demand(personnel_requirement.hospital_id, demands[personnel_requirement.hospital_id])
+    propositions.invalidate()
+    return document
 
 @app.post('/helpers', response_model=models.Helper)
 async def create_helper(helper: models.HelperBase, db: db.AsyncIOMotorDatabase = Depends(db.get_database), jwt_payload: dict = Depends(auth.auth)):
     """Create helper."""
-    return await crud.create_item('helpers', helper)
+    document = await crud.create_item('helpers', helper)
+    matching.add_helper(document)
+    propositions.invalidate()
+    return document
 
 @app.post('/hospitals', response_model=models.Hospital)
 async def create_hospital(hospital: models.HospitalBase, db: db.AsyncIOMotorDatabase = Depends(db.get_database), jwt_payload: dict = Depends(auth.auth)):
     """Post match."""
-    return await crud.create_item('hospitals', hospital)
-
-
-# TODO: correct the response_model
-@app.post('/nearest_hospital')  # , response_model=models.Hospital)
-async def find_nearest_hospitals(lon=None, lat=None):
-    """ Receives a position (long, lat) to find the nearest hospitals and
-    returns the closest one """
-    # MongoDB optimization to have a maximum limit on results
-    # As there are currently round abount 2800 hospitals we are safe with this
-    # limit as long as we stay in Germany
-    limit = 5000
-    # The currently shortest calculated distance
-    shortest_distance = None
-    shorest_hospital = None
-
-    # Get all Hospitals from MongoDB
-    hospitals_collection = db.get_database().get_collection('hospitals')
-    if not hospitals_collection:
-        raise HTTPException(404, detail='No hospitals collection found')
-
-    hospitals = await hospitals_collection.find().to_list(limit)
-    # Iterate over all hospitals
-    for h in hospitals:
-        # Calc distance two the startpoint
-        cur_d = calc_line_distance(
-            float(lon), float(lat),
-            float(h['location']['coordinates'][0]),
-            float(h['location']['coordinates'][1]))
-        # Safe if its the current shortest distance
-        if not shortest_distance or cur_d < shortest_distance:
-            shortest_distance = cur_d
-            shorest_hospital = h
-
-    logging.debug(
-            f'start_long: {lon}, start_lat: {lat}, calc_line_distance: '
-            f'{shortest_distance}, hospital: {shorest_hospital}')
-
-    return str(shorest_hospital)
+    document = await crud.create_item('hospitals', hospital)
+    index_hospital(document)
+    return document
+
+@app.post('/hospitals/batch', response_model=List[models.Hospital])
+async def create_hospitals(hospitals: List[models.HospitalBase], ordered: bool = True, db: db.AsyncIOMotorDatabase = Depends(db.get_database), jwt_payload: dict = Depends(auth.auth)):
+    """Create multiple hospitals at once."""
+    documents = await crud.create_items('hospitals', hospitals, ordered=ordered)
+    for document in documents:
+        index_hospital(document)
+    return documents
+
+
+# in-memory alternative to the 2dsphere index for nearest hospital lookups
+hospital_index = GridIndex(cell_size=0.1, metric="haversine")
+
+
+async def load_hospital_index():
+    """Build the in-memory hospital index from the database."""
+    if not settings.spatial_index_in_memory:
+        return
+    async for hospital in crud.iterate("hospitals", {'location': {'$ne': None}}, {'location': 1}, batch_size=5000):
+        hospital_index.insert(hospital['_id'], hospital['location']['coordinates'])
+
+
+def index_hospital(hospital: dict):
+    """Add a new hospital to the in-memory hospital index."""
+    if settings.spatial_index_in_memory and hospital.get('location'):
+        hospital_index.insert(hospital['_id'], hospital['location']['coordinates'])
+
+
+app.add_event_handler("startup", load_hospital_index)
+
+
+@app.post('/nearest_hospital', response_model=List[models.NearestHospital])
+async def find_nearest_hospitals(lon: float, lat: float, k: int = Query(1, ge=1, le=100), max_distance: float = None):
+    """Find the k hospitals nearest to a position (lon, lat).
+
+    Uses the 2dsphere index on the hospital locations, or the in-memory
+    hospital index if enabled. The results are ordered by their distance in
+    meters, which can be limited by "max_distance" (in meters as well).
+    """
+    if settings.spatial_index_in_memory:
+        found = hospital_index.nearest((lon, lat), k, None if max_distance is None else max_distance / 1000)
+        documents = await crud.find('hospitals', {'_id': {'$in': [key for _, key in found]}})
+        documents = {d['_id']: d for d in documents}
+        return [{**documents[key], 'distance': distance * 1000} for distance, key in found if key in documents]
+
+    geo_near = {
+        'near': {'type': 'Point', 'coordinates': [lon, lat]},
+        'distanceField': 'distance',
+        'spherical': True,
+    }
+    if max_distance is not None:
+        geo_near['maxDistance'] = max_distance
+    hospitals = await db.get_database().hospitals.aggregate([{'$geoNear': geo_near}, {'$limit': k}]).to_list(k)
+
+    logging.debug(f'start_long: {lon}, start_lat: {lat}, nearest hospitals: {[h["_id"] for h in hospitals]}')
+    return hospitals
+
+
+async def ndjson(collection: str, model, batch_size: int = 1000):
+    """Serialize a collection as newline delimited JSON, batch by batch."""
+    async for batch in crud.iterate_batches(collection, {}, batch_size=batch_size, sort=[('_id', 1)], analytics=True):
+        yield ''.join(model(**document).json(by_alias=True) + '\n' for document in batch)
+
+
+@app.get('/hospitals/export')
+async def export_hospitals(jwt_payload: dict = Depends(auth.auth)):
+    """Export all hospitals as newline delimited JSON."""
+    return StreamingResponse(ndjson('hospitals', models.Hospital), media_type='application/x-ndjson')
+
+
+@app.get('/helpers/export')
+async def export_helpers(jwt_payload: dict = Depends(auth.auth)):
+    """Export all helpers as newline delimited JSON."""
+    return StreamingResponse(ndjson('helpers', models.Helper), media_type='application/x-ndjson')
 
 
 def calc_line_distance(x1, y1, x2, y2):
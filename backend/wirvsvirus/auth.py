@@ -1,20 +1,30 @@
 # Authorization utilities
 
+import asyncio
 import functools
-from typing import Any, Dict, List, Optional
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
 
-import requests
-from authlib.jose import JWTClaims, jwt
+import httpx
+from authlib.jose import JsonWebKey, JWTClaims, jwt
 from authlib.jose.errors import JoseError
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
+from pymongo.errors import DuplicateKeyError
 from starlette.requests import Request
 from starlette.status import HTTP_401_UNAUTHORIZED
 
 from wirvsvirus.settings import settings
 from wirvsvirus import db, models, crud
 
+logger = logging.getLogger(__name__)
+
 JWK = Dict[str, Any]
 
 
@@ -30,16 +40,154 @@ class JWTAuthorizationCredentials(BaseModel):
     message: str
 
 
-@functools.lru_cache()
-def get_jwks() -> JWKS:
-    """Get JSON Web Key Set from auth settings.
+def jwks_from_url(url: str) -> Callable[[], Awaitable[JWKS]]:
+    """JSON Web Key Set source fetching the set from a url.
 
     More information: https://auth0.com/docs/tokens/concepts/jwks
     """
-    response = requests.get(settings.auth_jwks_uri, timeout=10)
-    response.raise_for_status()
-    response_json = response.json()
-    return JWKS(**response_json)
+    async def fetch() -> JWKS:
+        async with httpx.AsyncClient(timeout=settings.auth_http_timeout) as client:
+            response = await client.get(url)
+        response.raise_for_status()
+        return JWKS(**response.json())
+    return fetch
+
+
+def jwks_from_file(path: str) -> Callable[[], Awaitable[JWKS]]:
+    """JSON Web Key Set source reading the set from a local file."""
+    async def load() -> JWKS:
+        with open(path) as f:
+            return JWKS(**json.load(f))
+    return load
+
+
+class UnknownKeyError(JoseError):
+    error = 'invalid_key'
+
+
+class JWKSManager:
+    """Keep the JSON Web Key Set up to date.
+
+    The keys are fetched from "source" at startup and every
+    "refresh_interval" seconds in the background. Tokens signed with an
+    unknown key id trigger an early refetch, at most once every
+    "min_refetch_interval" seconds. Every fetch replaces the read-only map
+    of key ids to keys as a whole.
+    """
+
+    def __init__(self, source: Callable[[], Awaitable[JWKS]], refresh_interval: float = 3600.0,
+                 min_refetch_interval: float = 60.0):
+        """Initialize manager without keys."""
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.keys: Mapping[str, Any] = MappingProxyType({})
+        self.fetched_at = None
+        self.attempted_at = None
+        self._fetching = None
+        self._task = None
+
+    async def start(self):
+        """Fetch the keys and start refreshing them in the background."""
+        try:
+            await self.refresh()
+        except Exception:
+            logger.exception('fetching the json web key set failed')
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._refresh_periodically())
+
+    async def stop(self):
+        """Stop refreshing the keys."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def refresh(self):
+        """Fetch the keys, joining a fetch already in progress."""
+        if self._fetching is None or self._fetching.done():
+            self._fetching = asyncio.ensure_future(self._fetch())
+        await asyncio.shield(self._fetching)
+
+    async def refetch(self) -> bool:
+        """Refresh the keys unless tried recently, returns whether they were refreshed."""
+        if self.attempted_at is not None and time.monotonic() - self.attempted_at < self.min_refetch_interval:
+            return False
+        try:
+            await self.refresh()
+        except Exception:
+            logger.exception('fetching the json web key set failed')
+            return False
+        return True
+
+    def key(self, kid: Optional[str]):
+        """Get the key for a key id."""
+        keys = self.keys
+        if kid is None and len(keys) == 1:
+            # a key set with a single key doesn't need key ids
+            [kid] = keys
+        if kid not in keys:
+            raise UnknownKeyError(f'Unknown key id "{kid}"')
+        return keys[kid]
+
+    async def _fetch(self):
+        self.attempted_at = time.monotonic()
+        jwks = await self.source()
+        self.keys = MappingProxyType({jwk['kid']: JsonWebKey.import_key(jwk) for jwk in jwks.keys if jwk.get('kid')})
+        self.fetched_at = time.monotonic()
+        logger.info(f'fetched json web key set with key ids {list(self.keys)}')
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception('refreshing the json web key set failed')
+
+
+jwks_manager = JWKSManager(
+    jwks_from_file(settings.auth_jwks_file) if settings.auth_jwks_file else jwks_from_url(settings.auth_jwks_uri),
+    refresh_interval=settings.auth_jwks_refresh_interval,
+    min_refetch_interval=settings.auth_jwks_min_refetch_interval)
+
+
+class TokenCache:
+    """LRU cache of verified token payloads.
+
+    Entries are keyed by a hash of the token and expire with the token.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        """Initialize empty cache."""
+        self.maxsize = maxsize
+        self.entries: Dict[str, Tuple[float, JWTClaims]] = OrderedDict()
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[JWTClaims]:
+        """Get the payload of a token if cached and not expired."""
+        key = self.key(token)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, payload = entry
+        if expires <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return payload
+
+    def set(self, token: str, payload: JWTClaims):
+        """Cache the payload of a verified token until it expires."""
+        if not self.maxsize or not payload.get('exp'):
+            return
+        key = self.key(token)
+        self.entries[key] = (payload['exp'], payload)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
 
 
 class Auth(HTTPBearer):
@@ -49,25 +197,46 @@ class Auth(HTTPBearer):
     is signed by the correct authority.
     """
 
-    @functools.cached_property
-    def jwks(self) -> JWKS:
-        """Get json web key set."""
-        return get_jwks()
+    def __init__(self, key_set: JWKSManager = None, **kwargs):
+        """Initialize handler verifying tokens with the keys of "key_set"."""
+        super().__init__(**kwargs)
+        self.key_set = key_set or jwks_manager
 
     @functools.cached_property
-    def kid_to_jwk(self) -> Dict[str, JWK]:
-        """Map key ids to json web key."""
-        return {jwk["kid"]: jwk for jwk in self.jwks.keys if jwk.get("kid")}
+    def token_cache(self) -> TokenCache:
+        """Cache of verified tokens."""
+        return TokenCache(settings.auth_token_cache_size)
+
+    def load_key(self, header: dict, payload: dict):
+        """Select the key to verify a token with by its key id."""
+        return self.key_set.key(header.get('kid'))
 
-    def decode_jwt(self, token: str) -> JWTClaims:
-        """Verify jwt."""
+    def verify(self, token: str) -> JWTClaims:
+        """Verify the signature and claims of a token."""
+        payload = jwt.decode(token, self.load_key, claims_options={"iss": {"value": settings.auth_issuer}})
+        payload.validate()
+        return payload
+
+    async def decode_jwt(self, token: str) -> JWTClaims:
+        """Verify jwt.
+
+        Verified tokens are cached until they expire.
+        """
+        payload = self.token_cache.get(token)
+        if payload is not None:
+            return payload
         try:
-            payload = jwt.decode(token, self.jwks.keys, claims_options={"iss": {"value": settings.auth_issuer}})
-            payload.validate()
+            try:
+                payload = self.verify(token)
+            except UnknownKeyError:
+                # the keys might have been rotated
+                if not await self.key_set.refetch():
+                    raise
+                payload = self.verify(token)
         except JoseError as e:
-            breakpoint()
             raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail=e.args[0])
 
+        self.token_cache.set(token, payload)
         return payload
 
     async def __call__(self, request: Request) -> Optional[dict]:
@@ -75,7 +244,7 @@ class Auth(HTTPBearer):
             return {}
         credentials: HTTPAuthorizationCredentials = await super().__call__(request)
         token = credentials.credentials
-        payload = self.decode_jwt(token)
+        payload = await self.decode_jwt(token)
         if not payload.get('sub'):
             raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Needs "sub"')
         return payload
@@ -84,30 +253,162 @@ class Auth(HTTPBearer):
 auth = Auth()
 
 
-async def current_profile(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer), jwt_payload: dict = Depends(auth)) -> models.Profile:
+class UserInfoClient:
+    """Fetch user info from the identity provider.
+
+    Requests share one pooled async HTTP client. Responses are cached per
+    subject for "ttl" seconds, and concurrent lookups of the same subject wait
+    for a single request.
+    """
+
+    def __init__(self, url: str, ttl: float = 60.0, timeout: float = 5.0, max_connections: int = 20,
+                 maxsize: int = 1024):
+        """Initialize client."""
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.maxsize = maxsize
+        self.cache: Dict[str, Tuple[float, dict]] = OrderedDict()
+        self.pending: Dict[str, asyncio.Future] = {}
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Shared HTTP client, created on first use."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout, limits=httpx.Limits(max_connections=self.max_connections))
+        return self._client
+
+    async def close(self):
+        """Close the HTTP client's connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self.cache.clear()
+
+    async def get(self, subject: str, token: str) -> dict:
+        """Get the user info of a subject, using its access token."""
+        entry = self.cache.get(subject)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        if subject not in self.pending:
+            self.pending[subject] = asyncio.ensure_future(self._fetch(subject, token))
+            self.pending[subject].add_done_callback(lambda _: self.pending.pop(subject, None))
+        # shielded, so a cancelled request doesn't cancel the lookup for the others
+        return await asyncio.shield(self.pending[subject])
+
+    async def _fetch(self, subject: str, token: str) -> dict:
+        response = await self.client.get(self.url, headers={'Authorization': f'Bearer {token}'})
+        response.raise_for_status()
+        user_info = response.json()
+        self.cache.pop(subject, None)
+        self.cache[subject] = (time.monotonic() + self.ttl, user_info)
+        # entries are ordered by expiry, so drop from the front
+        while self.cache and (len(self.cache) > self.maxsize or next(iter(self.cache.values()))[0] <= time.monotonic()):
+            self.cache.popitem(last=False)
+        return user_info
+
+
+user_info_client = UserInfoClient(
+    settings.auth_issuer + 'userinfo', ttl=settings.auth_userinfo_ttl,
+    timeout=settings.auth_http_timeout, max_connections=settings.auth_http_max_connections)
+
+
+class ProfileCache:
+    """LRU cache of profile documents by user id.
+
+    Complete profiles can't be changed, so they are kept until evicted.
+    Users without a profile and bare profiles without a profile type, which
+    are completed later, are only remembered for "negative_ttl" seconds, so
+    profiles created or completed by other processes show up soon after.
+    """
+
+    def __init__(self, maxsize: int = 10000, negative_ttl: float = 5.0):
+        """Initialize empty cache."""
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        self.entries: Dict[str, Tuple[Optional[float], Optional[dict]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        """Get the profile of a user, None if there is none."""
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            expires, profile = entry
+            if expires is None or expires > time.monotonic():
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return profile
+        self.misses += 1
+        profile = await db.get_database().profiles.find_one({'user_id': user_id})
+        self.set(user_id, profile)
+        return profile
+
+    def set(self, user_id: str, profile: Optional[dict]):
+        """Cache the profile of a user, or that the user has none."""
+        if not self.maxsize:
+            return
+        complete = profile is not None and profile.get('profile_type') is not None
+        self.entries[user_id] = (None if complete else time.monotonic() + self.negative_ttl, profile)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Hit and miss counters."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+    def clear(self):
+        """Drop all cached profiles and reset the counters."""
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+
+profile_cache = ProfileCache(settings.auth_profile_cache_size, settings.auth_profile_negative_ttl)
+
+
+async def profile(jwt_payload: dict = Depends(auth)) -> Optional[dict]:
+    """Get the profile document of the authenticated user, None if there is none."""
+    return await profile_cache.get(jwt_payload['sub'])
+
+
+async def current_profile(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer()), jwt_payload: dict = Depends(auth)) -> models.BaseProfile:
     """Get current profile.
 
-    If a profile is not available, create one.
+    If a profile is not available, create a bare one with the email address
+    verified by the identity provider.
     """
     user_id = jwt_payload.get('sub')
     if not user_id:
         raise HTTPException(status_code=HTTP_401_UNAUTHORIZED,
                             detail='Invalid token payload. Must have valid user id')
-    profiles = db.get_database().profiles
-    result = await profiles.find_one({'user_id': jwt_payload['sub']})
+    result = await profile_cache.get(user_id)
 
     if result:
-        profile = models.Profile(**result)
+        profile = models.BaseProfile(**result)
     else:
         token = credentials.credentials
-        # TODO: replace with httpx if too slow, as not async
-        response = requests.get(settings.auth_issuer + 'userinfo', headers={'Authorization': f'Bearer {token}'})
-        user_info = response.json()
+        try:
+            user_info = await user_info_client.get(user_id, token)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == HTTP_401_UNAUTHORIZED:
+                raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Invalid token.')
+            raise HTTPException(status_code=502, detail='Identity provider failed.')
+        except httpx.HTTPError:
+            raise HTTPException(status_code=502, detail='Identity provider not reachable.')
         if not user_info.get('email_verified'):
             raise HTTPException(status_code=HTTP_401_UNAUTHORIZED,
                                 detail='Email not verified.')
         base_profile = models.BaseProfile(user_id=user_id, email=user_info['email'])
-        created = crud.create_item('profiles', base_profile)
-        profile = models.Profile(**created)
+        try:
+            created = await crud.create_item('profiles', base_profile)
+        except DuplicateKeyError:
+            # a concurrent request of the same user created the profile first
+            created = await db.get_database().profiles.find_one({'user_id': user_id})
+        profile_cache.set(user_id, created)
+        profile = models.BaseProfile(**created)
 
     return profile
@@ -33,3 +33,75 @@ def api(ctx, reload, **kwargs):
         reloader.watch_files(pathlib.Path(__file__).parent.glob("**/*.py"))
 
     uvicorn.run(app, host=settings.host, port=settings.port)
+
+
+@cli.command("import-csv")
+@click.argument("kind", type=click.Choice(["hospitals", "helpers"]))
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=1000, show_default=True, help="rows per bulk write")
+@click.option("--workers", type=int, help="processes validating rows [default: number of CPUs]")
+@click.option("--rejects", type=click.Path(dir_okay=False), help="CSV file to write invalid rows to")
+def import_csv(kind, file, batch_size, workers, rejects):
+    """Import hospitals or helpers from a CSV file.
+
+    Hospitals are read from the ArcGIS export, helper lists have a column per
+    helper field. Existing entries are updated, so imports can be repeated.
+    """
+    import asyncio
+    from wirvsvirus import db, importer_csv
+
+    to_operation = {"hospitals": importer_csv.upsert_hospital, "helpers": importer_csv.upsert_helper}[kind]
+
+    def progress(stats):
+        click.echo(f"\r{stats['rows']} rows, {stats['rejected']} rejected, "
+                   f"{stats['rows_per_second']:.0f} rows/s", nl=False, err=True)
+
+    db.connect()
+    try:
+        asyncio.get_event_loop().run_until_complete(db.ensure_indexes())
+        stats = asyncio.get_event_loop().run_until_complete(importer_csv.import_csv(
+            file, kind, to_operation, batch_size=batch_size, workers=workers,
+            rejects_file=rejects, progress=progress))
+    finally:
+        db.disconnect()
+    click.echo(err=True)
+    click.echo(f"Imported {stats['rows'] - stats['rejected']} {kind} ({stats['inserted']} new, "
+               f"{stats['updated']} updated, {stats['rejected']} rejected) in {stats['seconds']:.2f}s, "
+               f"{stats['rows_per_second']:.0f} rows/s")
+
+
+@cli.group()
+def indexes():
+    """Manage the database indexes."""
+
+
+@indexes.command()
+def ensure():
+    """Create the missing indexes."""
+    import asyncio
+    from wirvsvirus import db
+
+    db.connect()
+    try:
+        asyncio.get_event_loop().run_until_complete(db.ensure_indexes())
+    finally:
+        db.disconnect()
+
+
+@indexes.command()
+def report():
+    """List missing, unused and unregistered indexes.
+
+    Index usage is counted since the last start of the database server.
+    """
+    import asyncio
+    from wirvsvirus import db
+
+    db.connect()
+    try:
+        entries = asyncio.get_event_loop().run_until_complete(db.index_report())
+    finally:
+        db.disconnect()
+    for entry in entries:
+        ops = '-' if entry['ops'] is None else entry['ops']
+        click.echo(f"{entry['collection']:<24} {entry['name']:<32} {entry['status']:<13} {ops}")
@@ -1,23 +1,74 @@
 """CRUD utilities."""
 
-from typing import Optional, List
+from typing import AsyncIterator, List, Optional, Tuple
 from pydantic import BaseModel
 from wirvsvirus import db, models
 
 
-async def create_item(collection: str, item: BaseModel) -> dict:
-    """Simple create item convenience function."""
-    result = await db.get_database()[collection].insert_one(item.dict())
-    output = await db.get_database()[collection].find_one({'_id': result.inserted_id})
-    return output
+async def create_item(collection: str, item: BaseModel, verify: bool = False) -> dict:
+    """Simple create item convenience function.
+
+    Returns the inserted document, or the document as stored in the
+    database if "verify" is set, which costs an additional read.
+    """
+    document = item.dict()
+    result = await db.get_database()[collection].insert_one(document)
+    if verify:
+        return await db.get_database()[collection].find_one({'_id': result.inserted_id})
+    document['_id'] = result.inserted_id
+    return document
+
+async def create_items(collection: str, items: List[BaseModel], ordered: bool = True, verify: bool = False) -> List[dict]:
+    """Create multiple items with a single insert.
+
+    Ordered inserts stop at the first error, unordered inserts insert all
+    valid items and might be faster. In both cases errors raise a
+    pymongo.errors.BulkWriteError.
+    """
+    documents = [item.dict() for item in items]
+    if not documents:
+        return []
+    result = await db.get_database()[collection].insert_many(documents, ordered=ordered)
+    if verify:
+        return await find(collection, {'_id': {'$in': result.inserted_ids}})
+    for document, inserted_id in zip(documents, result.inserted_ids):
+        document['_id'] = inserted_id
+    return documents
 
 async def get_item(collection: str, id: str) -> Optional[dict]:
     """Get single item by id."""
     return await db.get_database()[collection].find_one({'_id': id})
 
-async def find(collection: str, query: dict, projection: dict = None) -> List[dict]:
-    """Find multiple."""
-    documents = []
-    async for document in db.get_database()[collection].find(query, projection):
-        documents.append(document)
-    return documents
+async def iterate(collection: str, query: dict, projection: dict = None, sort: List[Tuple[str, int]] = None,
+                  skip: int = 0, limit: int = 0, batch_size: int = None, analytics: bool = False) -> AsyncIterator[dict]:
+    """Stream documents.
+
+    Documents are fetched from the server in batches of "batch_size"
+    documents, so only one batch is held in memory at a time. Reads of whole
+    collections should set "analytics" to use the analytics read preference.
+    """
+    database = db.get_analytics_database() if analytics else db.get_database()
+    cursor = database[collection].find(query, projection, sort=sort, skip=skip, limit=limit)
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    async for document in cursor:
+        yield document
+
+async def iterate_batches(collection: str, query: dict, projection: dict = None, batch_size: int = 1000,
+                          **kwargs) -> AsyncIterator[List[dict]]:
+    """Stream documents in lists of "batch_size" documents."""
+    batch = []
+    async for document in iterate(collection, query, projection, batch_size=batch_size, **kwargs):
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def find(collection: str, query: dict, projection: dict = None, **kwargs) -> List[dict]:
+    """Find multiple.
+
+    Takes the same options as "iterate".
+    """
+    return [document async for document in iterate(collection, query, projection, **kwargs)]
@@ -0,0 +1,52 @@
+"""Batch and cache data loading within a request."""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List
+
+
+class DataLoader:
+    """Collect loads of single keys and resolve them with one batch call.
+
+    All keys requested within the same event loop iteration are passed to
+    ``batch_load`` together, which must return the values in the order of
+    the keys. Every key is only loaded once per loader, so create a loader
+    per request.
+    """
+
+    def __init__(self, batch_load: Callable[[List[Any]], Awaitable[List[Any]]]):
+        """Initialize loader."""
+        self.batch_load = batch_load
+        self.cache: Dict[Any, asyncio.Future] = {}
+        self.queue = []
+
+    def load(self, key) -> asyncio.Future:
+        """Load a single key."""
+        if key in self.cache:
+            return self.cache[key]
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.cache[key] = future
+        self.queue.append((key, future))
+        if len(self.queue) == 1:
+            loop.call_soon(self.dispatch)
+        return future
+
+    def load_many(self, keys) -> asyncio.Future:
+        """Load multiple keys."""
+        return asyncio.gather(*(self.load(key) for key in keys))
+
+    def dispatch(self):
+        """Start loading the queued keys as one batch."""
+        queue, self.queue = self.queue, []
+        asyncio.ensure_future(self.run_batch(queue))
+
+    async def run_batch(self, queue):
+        """Load a batch and resolve the futures of its keys."""
+        try:
+            values = await self.batch_load([key for key, _ in queue])
+        except Exception as e:
+            for _, future in queue:
+                future.set_exception(e)
+            return
+        for (_, future), value in zip(queue, values):
+            future.set_result(value)
@@ -1,9 +1,12 @@
 
 import abc
 import logging
-from typing import Optional
+from typing import Dict, List, Optional
 
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import IndexModel
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+from pymongo.errors import OperationFailure, PyMongoError
 from bson import ObjectId
 from pydantic import BaseModel, root_validator
 
@@ -14,22 +17,110 @@ logger = logging.getLogger(__name__)
 
 class DataBase:
     client: AsyncIOMotorClient = None
+    database: AsyncIOMotorDatabase = None
+    analytics_database: AsyncIOMotorDatabase = None
 
 
 db = DataBase()
 
 
 def get_database() -> AsyncIOMotorDatabase:
-    return db.client.get_default_database()
+    return db.database
+
+
+def get_analytics_database() -> AsyncIOMotorDatabase:
+    """Get the database for reading whole collections.
+
+    Uses the analytics read preference, so these reads can be routed to
+    secondaries and might lag behind recent writes.
+    """
+    return db.analytics_database
+
+
+def read_preference(name: str):
+    """Get a read preference by its name, e.g. "secondaryPreferred"."""
+    return make_read_preference(read_pref_mode_from_name(name), None)
+
+
+def client_options() -> dict:
+    """Client options from the settings."""
+    options = {
+        'maxPoolSize': settings.db_max_pool_size,
+        'minPoolSize': settings.db_min_pool_size,
+        'serverSelectionTimeoutMS': settings.db_server_selection_timeout_ms,
+        'connectTimeoutMS': settings.db_connect_timeout_ms,
+        'readPreference': settings.db_read_preference,
+    }
+    if settings.db_max_idle_time_ms is not None:
+        options['maxIdleTimeMS'] = settings.db_max_idle_time_ms
+    if settings.db_wait_queue_timeout_ms is not None:
+        options['waitQueueTimeoutMS'] = settings.db_wait_queue_timeout_ms
+    if settings.db_socket_timeout_ms is not None:
+        options['socketTimeoutMS'] = settings.db_socket_timeout_ms
+    if settings.db_compressors:
+        options['compressors'] = settings.db_compressors
+    return options
 
 
 def connect():
     logger.info('connecting to mongo')
     print(settings.db_url)
-    db.client = AsyncIOMotorClient(str(settings.db_url))
+    db.client = AsyncIOMotorClient(str(settings.db_url), **client_options())
+    db.database = db.client.get_default_database()
+    db.analytics_database = db.database.with_options(
+        read_preference=read_preference(settings.db_analytics_read_preference))
     logging.info('connected to mongo')
 
 
+async def ensure_indexes(indexes: Dict[str, List[IndexModel]] = None):
+    """Create the missing indexes of the registry ("models.INDEXES" by default).
+
+    Indexes which can't be created, e.g. a unique index over duplicates, are
+    logged and skipped. If the database isn't reachable, that is logged and
+    the remaining indexes are left for the next start.
+    """
+    if indexes is None:
+        from wirvsvirus.models import INDEXES as indexes
+    for collection, models in indexes.items():
+        for model in models:
+            try:
+                await get_database()[collection].create_indexes([model])
+            except OperationFailure as e:
+                logger.error(f'creating index {model.document["name"]} on {collection} failed: {e}')
+            except PyMongoError as e:
+                logger.error(f'creating indexes failed, the database is not available: {e}')
+                return
+
+
+async def index_report(indexes: Dict[str, List[IndexModel]] = None) -> List[dict]:
+    """Compare the indexes in the database with the registry.
+
+    Lists every index with its status: "missing" if registered but not
+    created, "unused" if it wasn't used since the server started,
+    "unregistered" if it isn't in the registry or "ok".
+    """
+    if indexes is None:
+        from wirvsvirus.models import INDEXES as indexes
+    report = []
+    for collection, models in indexes.items():
+        stats = await get_database()[collection].aggregate([{'$indexStats': {}}]).to_list(None)
+        usage = {s['name']: s['accesses']['ops'] for s in stats}
+        registered = {model.document['name'] for model in models}
+        for model in models:
+            name = model.document['name']
+            if name not in usage:
+                status = 'missing'
+            elif not usage[name]:
+                status = 'unused'
+            else:
+                status = 'ok'
+            report.append({'collection': collection, 'name': name, 'status': status, 'ops': usage.get(name)})
+        for name, ops in usage.items():
+            if name not in registered and name != '_id_':
+                report.append({'collection': collection, 'name': name, 'status': 'unregistered', 'ops': ops})
+    return report
+
+
 def disconnect():
     logging.info('closing mongodb connection')
     db.client.close()
@@ -1,8 +1,11 @@
+import base64
 import logging
+import re
 
 from fastapi import APIRouter, Request, HTTPException
 from graphene_pydantic import PydanticObjectType
 from graphql import GraphQLError
+from graphql.language import ast
 from graphql.execution.executors.asyncio import AsyncioExecutor
 from bson import ObjectId
 import graphene
@@ -10,12 +13,54 @@ from graphene_pydantic import PydanticObjectType
 from starlette.graphql import GraphQLApp
 from pydantic import ValidationError
 
-from wirvsvirus import models, db, crud
+from wirvsvirus import models, crud
 from wirvsvirus import auth
+from wirvsvirus.dataloader import DataLoader
 
 logger = logging.getLogger(__name__)
 
 
+def load_by_id(collection: str):
+    """Create a batch function loading documents by their id."""
+    async def batch_load(ids):
+        object_ids = [ObjectId(i) for i in ids if ObjectId.is_valid(i)]
+        documents = await crud.find(collection, {'_id': {'$in': object_ids}})
+        by_id = {str(d['_id']): d for d in documents}
+        return [by_id.get(i) for i in ids]
+    return batch_load
+
+
+def load_by_field(collection: str, field: str):
+    """Create a batch function loading the lists of documents referencing ids in a field."""
+    async def batch_load(ids):
+        documents = await crud.find(collection, {field: {'$in': list(ids)}})
+        by_field = {i: [] for i in ids}
+        for d in documents:
+            by_field[d[field]].append(d)
+        return [by_field[i] for i in ids]
+    return batch_load
+
+
+class Loaders:
+    """Data loaders of a single GraphQL request."""
+
+    def __init__(self):
+        self.hospitals = DataLoader(load_by_id('hospitals'))
+        self.helpers = DataLoader(load_by_id('helpers'))
+        self.personnel_requirements = DataLoader(load_by_id('personnel_requirements'))
+        self.hospital_personnel_requirements = DataLoader(load_by_field('personnel_requirements', 'hospital_id'))
+        self.helper_matches = DataLoader(load_by_field('matches', 'helper_id'))
+        self.personnel_requirement_matches = DataLoader(load_by_field('matches', 'personnel_requirement_id'))
+
+
+def get_loaders(info) -> Loaders:
+    """Get the data loaders of the current request."""
+    request = info.context['request']
+    if not hasattr(request.state, 'loaders'):
+        request.state.loaders = Loaders()
+    return request.state.loaders
+
+
 class Location(PydanticObjectType):
     class Meta:
         model = models.Location
@@ -26,7 +71,7 @@ class Helper(PydanticObjectType):
     matches = graphene.List(lambda: Match)
 
     async def resolve_matches(self, info):
-        documents = await crud.find('matches', {'helper_id': str(self.id)})
+        documents = await get_loaders(info).helper_matches.load(str(self.id))
         return [models.Match(**d) for d in documents]
 
     class Meta:
@@ -46,17 +91,14 @@ class Hospital(PydanticObjectType):
 
     async def resolve_matches(self, info):
         """Get all matches ascociated with the hospital."""
-        pr_documents = await crud.find('personnel_requirements', {'hospital_id': str(self.id)})
+        loaders = get_loaders(info)
+        pr_documents = await loaders.hospital_personnel_requirements.load(str(self.id))
         personnel_requirements_ids = [str(d['_id']) for d in pr_documents]
-        documents = []
-        # TODO: do this with "$in" bin i'm to stupid
-        for pr_id in personnel_requirements_ids :
-            sub_documents = await crud.find('matches', {'personnel_requirement_id': pr_id})
-            documents.extend(sub_documents)
-        return [models.Match(**d) for d in documents]
+        matches = await loaders.personnel_requirement_matches.load_many(personnel_requirements_ids)
+        return [models.Match(**d) for documents in matches for d in documents]
 
     async def resolve_personnel_requirements(self, info):
-        documents = await crud.find('personnel_requirements', {'hospital_id': str(self.id)})
+        documents = await get_loaders(info).hospital_personnel_requirements.load(str(self.id))
         return [models.PersonnelRequirement(**d) for d in documents]
 
     class Meta:
@@ -69,38 +111,128 @@ class Match(PydanticObjectType):
     helper = graphene.Field(Helper)
 
     async def resolve_helper(self, info):
-        document = await crud.get_item('helpers', id=ObjectId(self.helper_id))
+        document = await get_loaders(info).helpers.load(self.helper_id)
         if not document:
             raise GraphQLError('Helper does not exist.')
         return models.Helper(**document)
 
     async def resolve_personnel_requirement(self, info):
-        document = crud.get_item('personnel_requirements', id=ObjectId(self.personnel_requirements_id))
+        document = await get_loaders(info).personnel_requirements.load(self.personnel_requirement_id)
         if not document:
-            raise GraphQLError('Helper does not exist.')
+            raise GraphQLError('Personnel requirement does not exist.')
         return models.PersonnelRequirement(**document)
 
     class Meta:
         model = models.Match
 
 
+class HospitalConnection(graphene.relay.Connection):
+
+    class Meta:
+        node = Hospital
+
+
+def encode_cursor(id: str) -> str:
+    """Encode a document id into an opaque cursor."""
+    return base64.b64encode(f'cursor:{id}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> ObjectId:
+    """Decode a cursor into a document id."""
+    try:
+        return ObjectId(base64.b64decode(cursor).decode().split(':', 1)[1])
+    except Exception:
+        raise GraphQLError('Invalid cursor.')
+
+
+def selected_fields(selection_set, path=()):
+    """Get the names of the fields selected below a path.
+
+    Returns None if the selection contains fragments.
+    """
+    fields = {}
+    for selection in selection_set.selections:
+        if not isinstance(selection, ast.Field):
+            return None
+        fields[selection.name.value] = selection
+    if not path:
+        return set(fields)
+    field = fields.get(path[0])
+    if field is None or field.selection_set is None:
+        return set()
+    return selected_fields(field.selection_set, path[1:])
+
+
+def hospital_projection(info, path=()):
+    """Derive a mongo projection for hospitals from the GraphQL selection."""
+    names = selected_fields(info.field_asts[0].selection_set, path)
+    if names is None:
+        return None
+    fields = {re.sub('([A-Z])', r'_\1', name).lower() for name in names}
+    projection = {field: 1 for field in fields & set(models.Hospital.__fields__) - {'id'}}
+    projection['_id'] = 1
+    return projection
+
+
+async def find_hospitals(first=None, after=None, state=None, bbox=None, projection=None):
+    """Find a page of hospitals ordered by id.
+
+    bbox is given as [min longitude, min latitude, max longitude, max latitude].
+    One more hospital than requested is returned to tell if there is a next page.
+    """
+    query = {}
+    if after:
+        query['_id'] = {'$gt': decode_cursor(after)}
+    if state:
+        query['address_state'] = state
+    if bbox:
+        if len(bbox) != 4:
+            raise GraphQLError('bbox needs four coordinates.')
+        min_lon, min_lat, max_lon, max_lat = bbox
+        query['location'] = {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [[
+            [min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]
+        ]]}}}
+    documents = await crud.find('hospitals', query, projection, sort=[('_id', 1)], limit=0 if first is None else first + 1)
+    model = models.Hospital if projection is None else models.PartialHospital
+    return [model(**d) for d in documents]
+
+
 class Query(graphene.ObjectType):
     hospital = graphene.Field(Hospital, id=graphene.ID())
-    hospitals = graphene.List(Hospital)
+    hospitals = graphene.List(
+        Hospital, first=graphene.Int(), state=graphene.String(), bbox=graphene.List(graphene.Float)
+    )
+    hospitals_connection = graphene.relay.ConnectionField(
+        HospitalConnection, state=graphene.String(), bbox=graphene.List(graphene.Float)
+    )
     helper = graphene.Field(Hospital, id=graphene.ID())
 
     async def resolve_hospital(self, info, id):
-        document = await crud.get_item('hospitals', ObjectId(id))
+        document = await get_loaders(info).hospitals.load(id)
         if not document:
             raise GraphQLError('No hospital available for this id.')
         return models.Hospital(**document)
 
-    async def resolve_hospitals(self, info):
-        documents = await crud.find('hospitals', {})
-        return [models.Hospital(**d) for d in documents]
+    async def resolve_hospitals(self, info, first=None, state=None, bbox=None):
+        """Get the first hospitals, use hospitalsConnection to page through them."""
+        hospitals = await find_hospitals(first, None, state, bbox, hospital_projection(info))
+        return hospitals[:first]
+
+    async def resolve_hospitals_connection(self, info, first=50, after=None, state=None, bbox=None, **kwargs):
+        """Get a page of hospitals with relay style cursor pagination."""
+        hospitals = await find_hospitals(first, after, state, bbox, hospital_projection(info, ('edges', 'node')))
+        edges = [HospitalConnection.Edge(node=h, cursor=encode_cursor(h.id)) for h in hospitals[:first]]
+        return HospitalConnection(edges=edges, page_info=graphene.relay.PageInfo(
+            has_next_page=len(hospitals) > first,
+            has_previous_page=after is not None,
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+        ))
 
     async def resolve_helper(self, info, id):
-        document = await db.get_database().helpers.find_one({'_id': ObjectId(id)})
+        document = await get_loaders(info).helpers.load(id)
+        if not document:
+            raise GraphQLError('No helper available for this id.')
         return models.Helper(**document)
 
 
@@ -5,89 +5,214 @@ developers and the project database can be initially filled. The request from
 the API is prepared, but not functional yet. Use the CSV importer as defined
 in the main function.
 
-Run this script only ONCE, otherwise you will have duplicates in the database!
+Hospitals are upserted by an id derived from their GlobalID, so the import can
+be repeated to update the data without creating duplicates.
 """
 import asyncio
 import csv
 import hashlib
 import logging
+import multiprocessing
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
 
 from wirvsvirus import db
 
-from wirvsvirus.models import HospitalBase
-from wirvsvirus.crud import create_item
+from wirvsvirus.models import HelperBase, HospitalBase
+
+# fields managed by the application, which a re-import must not overwrite
+APPLICATION_FIELDS = {'profile_id', 'personnel_requirement_ids'}
+
+
+def hospital_id(global_id: str) -> ObjectId:
+    """Derive a stable hospital id from the ArcGIS GlobalID."""
+    # the GlobalID isn't a valid ObjectId, so hash it down to 24 hex chars
+    return ObjectId(hashlib.sha224(global_id.encode('utf-8')).hexdigest()[:24])
+
+
+def parse_hospital(row: dict) -> HospitalBase:
+    """Create a hospital from a row of the ArcGIS CSV export."""
+    # TODO: Quickly hacked, probably better to cmap the fields and
+    #       throw them into the constructor via kwargs-dictionary
+
+    # This should be the way to go for my understanding,
+    # regarding the mongodb docs:
+    # https://docs.mongodb.com/manual/geospatial-queries/
+    loc_dict = {
+        'type': 'Point',
+        'coordinates': [row["X"], row["Y"]]
+        }
+
+    return HospitalBase(
+        name=row["name"],
+        address=row["address_full"],
+        website=row["contact_website"],
+        phone_number=row["contact_phone"],
+        operator=row["operator"],
+        operator_type=row["operator_type"],
+        contact_email=row["contact_email"],
+        contact_fax=row["contact_fax"],
+        addr=row["addr"],
+        address_full=row["address_full"],
+        address_street=row["address_street"],
+        address_housenumber=row["address_housenumber"],
+        address_city=row["address_city"],
+        address_suburb=row["address_suburb"],
+        address_subdistrict=row["address_subdistrict"],
+        address_district=row["address_district"],
+        address_province=row["address_province"],
+        address_state=row["address_state"],
+        denomination=row["denomination"],
+        religion=row["religion"],
+        emergency=row["emergency"],
+        rooms=row["rooms"],
+        beds=row["beds"],
+        capacity=row["capacity"],
+        wheelchair=row["wheelchair"],
+        wikidata=row["wikidata"],
+        wikipedia=row["wikipedia"],
+        orig_fid=row["ORIG_FID"],
+        globalid=row["GlobalID"],
+        location=loc_dict
+        )
+
+
+def upsert_hospital(row: dict) -> UpdateOne:
+    """Create the upsert operation for a row of the ArcGIS CSV export."""
+    hospital = parse_hospital(row)
+    return UpdateOne(
+        {'_id': hospital_id(row["GlobalID"])},
+        {'$set': hospital.dict(exclude=APPLICATION_FIELDS),
+         '$setOnInsert': hospital.dict(include=APPLICATION_FIELDS)},
+        upsert=True)
+
+
+def upsert_helper(row: dict) -> UpdateOne:
+    """Create the upsert operation for a row of a helper list.
+
+    The columns are named like the helper fields, activity ids are separated
+    by ";" and the optional "longitude" and "latitude" columns give the
+    location. Helpers are identified by their email address.
+    """
+    row = {key: value for key, value in row.items() if value not in ('', None)}
+    row['activity_ids'] = [a.strip() for a in row.get('activity_ids', '').split(';') if a.strip()]
+    if 'longitude' in row and 'latitude' in row:
+        row['location'] = {'type': 'Point', 'coordinates': [row.pop('longitude'), row.pop('latitude')]}
+    helper = HelperBase(**row)
+    return UpdateOne({'email': helper.email}, {'$set': helper.dict()}, upsert=True)
 
 
-class IdempotentHospital(HospitalBase):
-    _id: str
+def validate_rows(to_operation: Callable[[dict], UpdateOne], rows: List[dict]) -> Tuple[list, list]:
+    """Turn rows into write operations, collecting the rows that fail as rejects."""
+    operations, rejects = [], []
+    for row in rows:
+        try:
+            operations.append(to_operation(row))
+        except Exception as e:
+            rejects.append({**row, 'error': str(e).replace('\n', ' ')})
+    return operations, rejects
 
 
-async def get_data_from_arcgis_file(file) -> list:
-    """ Simulates an API call by reading the json from file, for testing and to
-    prevent IP Blocks """
-    print("Info: Run this import only once, otherwise you will have "
-          "duplicates in the database!")
-    import_count = 0
-    with open(file, 'r', encoding="utf-8-sig") as csvfile:
+def read_chunks(file, size: int):
+    """Read the rows of a CSV file in lists of "size" rows."""
+    with open(file, 'r', encoding="utf-8-sig", newline='') as csvfile:
         reader = csv.DictReader(csvfile, delimiter=',')
-        logging.info(f"Running import from {file} ...")
+        chunk = []
         for row in reader:
-            # TODO: Quickly hacked, probably better to cmap the fields and
-            #       throw them into the constructor via kwargs-dictionary
-
-            # Creating an access id from the global id for idempotence
-            # As the database only accepted 24 chars I had to hash them
-            # TODO: Verify if its better to use the raw GlobalID and allow it
-            #       as a key in the database
-            mongo_id = hashlib.sha224(
-                row["GlobalID"].encode('utf-8')).hexdigest()
-            mongo_id = mongo_id[:24]
-
-            # This should be the way to go for my understanding,
-            # regarding the mongodb docs:
-            # https://docs.mongodb.com/manual/geospatial-queries/
-            loc_dict = {
-                'type': 'Point',
-                'coordinates': [row["X"], row["Y"]]
-                }
-
-            hb = IdempotentHospital(
-                _id=mongo_id,
-                name=row["name"],
-                address=row["address_full"],
-                website=row["contact_website"],
-                phone_number=row["contact_phone"],
-                operator=row["operator"],
-                operator_type=row["operator_type"],
-                contact_email=row["contact_email"],
-                contact_fax=row["contact_fax"],
-                addr=row["addr"],
-                address_full=row["address_full"],
-                address_street=row["address_street"],
-                address_housenumber=row["address_housenumber"],
-                address_city=row["address_city"],
-                address_suburb=row["address_suburb"],
-                address_subdistrict=row["address_subdistrict"],
-                address_district=row["address_district"],
-                address_province=row["address_province"],
-                address_state=row["address_state"],
-                denomination=row["denomination"],
-                religion=row["religion"],
-                emergency=row["emergency"],
-                rooms=row["rooms"],
-                beds=row["beds"],
-                capacity=row["capacity"],
-                wheelchair=row["wheelchair"],
-                wikidata=row["wikidata"],
-                wikipedia=row["wikipedia"],
-                orig_fid=row["ORIG_FID"],
-                globalid=row["GlobalID"],
-                location=loc_dict
-                )
-            await create_item("hospitals", hb)
-            import_count += 1
-    print(f"Imported {import_count} hospitals into mongodb")
+            chunk.append(row)
+            if len(chunk) == size:
+                yield reader.fieldnames, chunk
+                chunk = []
+        if chunk:
+            yield reader.fieldnames, chunk
+
+
+async def import_csv(file, collection: str, to_operation: Callable[[dict], UpdateOne], batch_size: int = 1000,
+                     workers: int = None, queue_size: int = None, rejects_file=None, progress=None) -> dict:
+    """Import a CSV file into a collection.
+
+    The file is read in chunks of "batch_size" rows, which a process pool
+    turns into write operations with "to_operation" (a module level function,
+    so it can be pickled). The pending chunks are kept in a bounded queue in
+    file order, so reading pauses while "queue_size" chunks wait to be
+    written, and every chunk is written with one unordered bulk write. Rows
+    that fail validation are written to "rejects_file" with the error instead
+    of aborting the import.
+
+    "progress" is called with the statistics after each chunk.
+    """
+    loop = asyncio.get_event_loop()
+    target = db.get_database()[collection]
+    stats = {'rows': 0, 'inserted': 0, 'updated': 0, 'rejected': 0}
+    start = time.perf_counter()
+    rejects, rejects_writer = None, None
+    workers = workers or os.cpu_count() or 1
+
+    # spawn the workers, forking would copy the threads motor and pymongo started
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        queue = asyncio.Queue(maxsize=queue_size or 2 * workers)
+
+        async def produce():
+            try:
+                for fieldnames, chunk in read_chunks(file, batch_size):
+                    await queue.put((fieldnames, loop.run_in_executor(executor, validate_rows, to_operation, chunk)))
+            except Exception:
+                # stop the consumer, which raises the error when awaiting the producer
+                await queue.put(None)
+                raise
+            await queue.put(None)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                fieldnames, future = item
+                operations, rejected = await future
+                if operations:
+                    result = await target.bulk_write(operations, ordered=False)
+                    stats['inserted'] += result.upserted_count
+                    stats['updated'] += result.modified_count
+                if rejected and rejects_file:
+                    if rejects is None:
+                        rejects = open(rejects_file, 'w', encoding='utf-8', newline='')
+                        rejects_writer = csv.DictWriter(rejects, [*fieldnames, 'error'])
+                        rejects_writer.writeheader()
+                    rejects_writer.writerows(rejected)
+                stats['rows'] += len(operations) + len(rejected)
+                stats['rejected'] += len(rejected)
+                stats['seconds'] = time.perf_counter() - start
+                stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+                if progress:
+                    progress(stats)
+            await producer
+        finally:
+            producer.cancel()
+            if rejects is not None:
+                rejects.close()
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+
+async def get_data_from_arcgis_file(file, batch_size: int = 1000, **kwargs) -> dict:
+    """Import the hospitals of an ArcGIS CSV export.
+
+    Takes the same options as "import_csv" and returns the import statistics.
+    """
+    logging.info(f"Running import from {file} ...")
+    stats = await import_csv(file, 'hospitals', upsert_hospital, batch_size=batch_size, **kwargs)
+    print(f"Imported {stats['rows']} hospitals into mongodb ({stats['inserted']} new, {stats['updated']} updated) "
+          f"in {stats['seconds']:.2f}s, {stats['rows_per_second']:.0f} rows/s")
+    return stats
 
 
 def transform_arcgis_data(hospitals):
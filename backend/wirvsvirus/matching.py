@@ -1,76 +1,690 @@
 """Model for matching of hospitals and helpers."""
 
-from math import sqrt
+import logging
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from ortools.graph.python import min_cost_flow
 from ortools.sat.python import cp_model
 
+from wirvsvirus.spatial import KM_PER_DEGREE, GridIndex
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+
 
 class MatchingModel:
+    """Allocate helpers to hospitals based on skill demand and distance.
+
+    By default every (hospital, helper) pair is an edge, with an allocation
+    variable per skill of the helper the hospital demands.
+    With ``sparse=True`` only candidate edges are created: pairs where the
+    helper has at least one activity the hospital demands and, if
+    ``max_distance`` is given, where the distance is within that radius.
+
+    Distances are held in a (hospital, helper) matrix indexed by position.
+    The "euclidean" metric measures tenths of degrees, "haversine" measures
+    great-circle kilometres and expects GeoJSON (longitude, latitude) points.
+    In sparse mode no matrix is built: ``distances`` only maps the candidate
+    edges to their distance. With a ``max_distance`` the hospitals near each
+    helper are looked up in a spatial index, otherwise the candidates are
+    found in chunks of hospitals.
+
+    The problem is solved by an engine: ``solve`` dispatches to the method
+    ``solve_<engine>``, so further engines can be added by subclassing. Every
+    engine stores the same ``results`` shape, including the solver ``status``
+    and the objective ``bound``, and maps the allocated (hospital, helper)
+    positions to the skill the helper fills in ``allocated_skills``.
+
+    CP-SAT can be bounded by ``max_time`` seconds and ``relative_gap``; it
+    then returns the best solution found so far with status "FEASIBLE".
+    """
 
     configuration: dict
     results: dict = {}
 
-    def __init__(self, hospitals, worker):
+    engines = ("cp_sat", "min_cost_flow")
+
+    def __init__(self, hospitals, worker, sparse=False, max_distance=None, metric="euclidean", engine="cp_sat", hint=None,
+                 max_time=None, num_workers=None, relative_gap=None):
         """Initialize matching model."""
         self.hospitals = hospitals
         self.worker = worker
-        self.distances = self.calculate_distances()
+        self.sparse = sparse
+        self.max_distance = max_distance
+        self.metric = metric
+        self.engine = engine
+        self.hint = hint
+        self.max_time = max_time
+        self.num_workers = num_workers
+        self.relative_gap = relative_gap
+        self.worker_skills, self.skill_index = self.index_skills()
+        if self.sparse and self.max_distance is not None:
+            self.distances, self.edges = self.find_nearby_edges()
+        elif self.sparse:
+            self.distances, self.edges = self.find_candidate_edges()
+        else:
+            self.distances = self.calculate_distances()
+            self.edges = self.find_edges()
         self.model = cp_model.CpModel()
 
     def calculate_distances(self):
-        """Calculate distances betwenn worker and hospitals."""
+        """Calculate the distance matrix between hospitals and worker."""
+        return distance_matrix(coordinates(self.hospitals), coordinates(self.worker), self.metric)
+
+    def index_skills(self):
+        """Index the activity sets of the worker and the worker positions per skill."""
+        worker_skills = [frozenset(w["activity_ids"]) for w in self.worker]
+        skill_index = {}
+        for j, skills in enumerate(worker_skills):
+            for skill in skills:
+                skill_index.setdefault(skill, []).append(j)
+        return worker_skills, skill_index
+
+    def find_edges(self):
+        """Find the (hospital position, helper position) pairs to model.
+
+        Edges are ordered by hospital and then by helper.
+        """
+        return [(i, j) for i in range(len(self.hospitals)) for j in range(len(self.worker))]
+
+    def find_candidate_edges(self, chunk_size=1000):
+        """Find the sparse edges of helpers with a skill the hospital demands.
+
+        Only a boolean chunk of the (hospital, helper) candidates is held at a
+        time and distances are only calculated for the candidate edges.
+        Returns a mapping from edge to distance and the ordered edges.
+        """
+        skills = sorted({skill for h in self.hospitals for skill in h["demand"]})
+        demanded = np.zeros((len(self.hospitals), len(skills)), dtype=bool)
+        for i, h in enumerate(self.hospitals):
+            demanded[i] = [h["demand"].get(skill, 0) > 0 for skill in skills]
+        offered = np.zeros((len(self.worker), len(skills)), dtype=bool)
+        for k, skill in enumerate(skills):
+            offered[self.skill_index.get(skill, []), k] = True
+        coords_h, coords_w = coordinates(self.hospitals), coordinates(self.worker)
+        distances = {}
+        for start in range(0, len(self.hospitals), chunk_size):
+            rows, columns = np.nonzero(demanded[start:start + chunk_size] @ offered.T)
+            rows += start
+            row_distances = pair_distances(coords_h[rows], coords_w[columns], self.metric)
+            distances.update(zip(zip(rows.tolist(), columns.tolist()), row_distances.tolist()))
+        return distances, list(distances)
+
+    def find_nearby_edges(self):
+        """Find the sparse edges within max_distance through a spatial index.
+
+        Returns a mapping from edge to distance and the ordered edges.
+        """
+        scale = 10 if self.metric == "euclidean" else 1
+        # distances are truncated to integers, so search a little further
+        radius = (self.max_distance + 1) / scale
+        radius_degrees = radius if self.metric == "euclidean" else radius / KM_PER_DEGREE
+        index = GridIndex(cell_size=max(radius_degrees, 0.01), metric=self.metric)
+        coords_h = coordinates(self.hospitals)
+        demanded = [{skill for skill, demand in h["demand"].items() if demand > 0} for h in self.hospitals]
+        for i, skills in enumerate(demanded):
+            if skills:
+                index.insert(i, coords_h[i])
         distances = {}
-        for h in self.hospitals:
-            distances[h["_id"]] = {}
-            coords_h = h["location"]["coordinates"]
-            for w in self.worker:
-                coords_w = w["location"]["coordinates"]
-                distances[h["_id"]][w["_id"]] = int(10 * sqrt((coords_h[0] - coords_w[0])**2 + (coords_h[1] - coords_w[1])**2))
-        return distances
+        for j, coords_w in enumerate(coordinates(self.worker)):
+            candidates = sorted(i for _, i in index.within(coords_w, radius) if not demanded[i].isdisjoint(self.worker_skills[j]))
+            if not candidates:
+                continue
+            row = distance_matrix(coords_h[candidates], coords_w[np.newaxis], self.metric)[:, 0]
+            for i, distance in zip(candidates, row):
+                if distance <= self.max_distance:
+                    distances[i, j] = int(distance)
+        return distances, sorted(distances)
 
     def solve(self):
-        """Solve matching model."""
+        """Solve matching model with the configured engine."""
+        if self.engine not in self.engines:
+            raise ValueError(f"Unknown matching engine {self.engine!r}")
+        getattr(self, f"solve_{self.engine}")()
+
+    def solve_cp_sat(self):
+        """Solve matching model with the CP-SAT solver."""
         self.create_variables()
+        if self.hint:
+            self.add_hints()
         self.add_constraints()
         self.add_objective()
         self.solver = cp_model.CpSolver()
-        status = self.solver.Solve(self.model)
+        if self.max_time is not None:
+            self.solver.parameters.max_time_in_seconds = self.max_time
+        if self.num_workers is not None:
+            self.solver.parameters.num_search_workers = self.num_workers
+        if self.relative_gap is not None:
+            self.solver.parameters.relative_gap_limit = self.relative_gap
+        self.progress = SolutionProgress()
+        self.status = self.solver.Solve(self.model, self.progress)
         self.results = self.get_results()
 
     def create_variables(self):
-        """Create allocation variables."""
+        """Create allocation variables.
+
+        There is a variable per edge and skill the helper offers and the
+        hospital demands, so a helper fills the demand of a single skill.
+        """
         self.allocation = {}
-        for h in self.hospitals:
-            self.allocation[h["_id"]] = {}
-            for w in self.worker:
-                name = f'allocation_{h["_id"]}_{w["_id"]}'
-                self.allocation[h["_id"]][w["_id"]] = self.model.NewBoolVar(name)
+        for i, j in self.edges:
+            demand = self.hospitals[i]["demand"]
+            for skill in sorted(self.worker_skills[j]):
+                if demand.get(skill, 0) > 0:
+                    name = f'allocation_{self.hospitals[i]["_id"]}_{self.worker[j]["_id"]}_{skill}'
+                    self.allocation[i, j, skill] = self.model.NewBoolVar(name)
+
+    def add_hints(self):
+        """Hint a previous solution (same results shape) to the solver."""
+        allocated = {(a["hospital_id"], helper_id) for a in self.hint["allocations"] for helper_id in a["helper_ids"]}
+        hinted = set()
+        for (i, j, skill), variable in self.allocation.items():
+            # the results don't tell the skill, so hint the first one
+            hint = (i, j) not in hinted and (str(self.hospitals[i]["_id"]), str(self.worker[j]["_id"])) in allocated
+            if hint:
+                hinted.add((i, j))
+            self.model.AddHint(variable, hint)
 
     def add_constraints(self):
-        """Add constraints."""
-        # ensure that a worker can only be allocated once to a hospital
-        for w in self.worker:
-            self.model.Add(sum(self.allocation[h["_id"]][w["_id"]] for h in self.hospitals) <= 1)
+        """Add constraints.
+
+        Allocation variables are bucketed per worker and per (hospital, skill)
+        in a single pass.
+        """
+        by_worker = {}
+        by_hospital_skill = {}
+        for (i, j, skill), variable in self.allocation.items():
+            by_worker.setdefault(j, []).append(variable)
+            by_hospital_skill.setdefault((i, skill), []).append(variable)
+        # ensure that a worker can only be allocated once
+        for variables in by_worker.values():
+            self.model.Add(cp_model.LinearExpr.Sum(variables) <= 1)
         # match the hospital demands based on skills
-        for h in self.hospitals:
-            for skill, demand in h["demand"].items():
-                self.model.Add(sum(self.allocation[h["_id"]][w["_id"]] for w in self.worker if skill in w["activity_ids"]) <= demand)
+        for (i, skill), variables in by_hospital_skill.items():
+            self.model.Add(cp_model.LinearExpr.Sum(variables) <= self.hospitals[i]["demand"][skill])
 
     def add_objective(self):
         """Add an objective."""
-        # reward each match with 100
-        reward = sum(100 * self.allocation[h["_id"]][w["_id"]] for h in self.hospitals for w in self.worker)
-        # penalize the sum of distances for allocated worker capacity
-        distance_penalty = sum(self.distances[h["_id"]][w["_id"]] * self.allocation[h["_id"]][w["_id"]] for h in self.hospitals for w in self.worker)
-        self.model.Maximize(reward - distance_penalty)
+        # reward each match with 100 and penalize the distance of allocated
+        # worker capacity
+        variables = list(self.allocation.values())
+        coefficients = [100 - int(self.distances[i, j]) for i, j, _ in self.allocation]
+        self.model.Maximize(cp_model.LinearExpr.WeightedSum(variables, coefficients))
 
     def get_results(self):
         """Get the allocation results."""
         results = {"objective": self.solver.ObjectiveValue(),
-                   "allocations": []}
-        for h in self.hospitals:
-            allocation = {"hospital_id": str(h["_id"]), "helper_ids": []}
-            for w in self.worker:
-                if self.solver.Value(self.allocation[h["_id"]][w["_id"]]) == True:
-                    allocation["helper_ids"].append(str(w["_id"]))
-            results["allocations"].append(allocation)
+                   "bound": self.solver.BestObjectiveBound(),
+                   "status": self.solver.StatusName(self.status),
+                   "allocations": [{"hospital_id": str(h["_id"]), "helper_ids": []} for h in self.hospitals]}
+        self.allocated_skills = {}
+        if self.status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            return results
+        for (i, j, skill), variable in self.allocation.items():
+            if self.solver.Value(variable):
+                results["allocations"][i]["helper_ids"].append(str(self.worker[j]["_id"]))
+                self.allocated_skills[i, j] = skill
         return results
+
+    def solve_min_cost_flow(self):
+        """Solve matching model as a min-cost-flow problem.
+
+        The network is source -> helper -> (hospital, skill) -> sink, where
+        each helper arc costs the distance minus the match reward of 100 and
+        each (hospital, skill) node drains at most its demand. A zero-cost
+        source -> sink arc lets helpers stay unassigned.
+
+        As in the CP-SAT model, a helper with several activities only uses up
+        the capacity of the one skill they are allocated for, so both engines
+        reach the same objective.
+        """
+        source, sink = 0, 1
+        flow = min_cost_flow.SimpleMinCostFlow()
+        skill_nodes = {}
+        helper_arcs = []
+        assigned_helpers = set()
+        for i, j in self.edges:
+            for skill in self.worker_skills[j]:
+                if self.hospitals[i]["demand"].get(skill, 0) <= 0:
+                    continue
+                if (i, skill) not in skill_nodes:
+                    skill_nodes[i, skill] = 2 + len(self.worker) + len(skill_nodes)
+                arc = flow.add_arc_with_capacity_and_unit_cost(
+                    2 + j, skill_nodes[i, skill], 1, int(self.distances[i, j]) - 100)
+                helper_arcs.append((arc, i, j, skill))
+                assigned_helpers.add(j)
+        for j in assigned_helpers:
+            flow.add_arc_with_capacity_and_unit_cost(source, 2 + j, 1, 0)
+        for (i, skill), node in skill_nodes.items():
+            flow.add_arc_with_capacity_and_unit_cost(node, sink, self.hospitals[i]["demand"][skill], 0)
+        flow.add_arc_with_capacity_and_unit_cost(source, sink, len(assigned_helpers), 0)
+        flow.set_node_supply(source, len(assigned_helpers))
+        flow.set_node_supply(sink, -len(assigned_helpers))
+
+        status = flow.solve()
+        if status != flow.OPTIMAL:
+            raise RuntimeError(f"Min cost flow failed with status {status}")
+
+        allocated = sorted((j, i, skill) for arc, i, j, skill in helper_arcs if flow.flow(arc) > 0)
+        self.results = {"objective": float(-flow.optimal_cost()),
+                        "bound": float(-flow.optimal_cost()),
+                        "status": "OPTIMAL",
+                        "allocations": [{"hospital_id": str(h["_id"]), "helper_ids": []} for h in self.hospitals]}
+        self.allocated_skills = {(i, j): skill for j, i, skill in allocated}
+        for j, i, _ in allocated:
+            self.results["allocations"][i]["helper_ids"].append(str(self.worker[j]["_id"]))
+
+
+class SolutionProgress(cp_model.CpSolverSolutionCallback):
+    """Log every improving solution found by CP-SAT."""
+
+    def __init__(self):
+        """Initialize progress."""
+        super().__init__()
+        self.solutions = []
+
+    def on_solution_callback(self):
+        """Record objective and bound of the new solution."""
+        solution = {"objective": self.ObjectiveValue(), "bound": self.BestObjectiveBound(), "wall_time": self.WallTime()}
+        self.solutions.append(solution)
+        logger.info(f"matching solution {len(self.solutions)}: {solution}")
+
+
+class PartitionedMatchingModel:
+    """Split the matching into independent regional sub-problems.
+
+    Hospitals are grouped into partitions, either by grid cells of
+    ``cell_size`` degrees or by a document field such as ``address_state``.
+    Every helper joins the partition of the nearest hospital demanding one of
+    their activities, so helpers close to a border go to a hospital across it
+    that needs them and no helper is allocated twice. The partitions are
+    solved concurrently in a process pool with ``MatchingModel``. Afterwards
+    a border round matches the helpers left over to the demand left over
+    across all partitions, so a partition's surplus can still fill the demand
+    of its neighbours.
+
+    Pass a long-lived pool from ``create_executor`` as ``executor`` to reuse
+    its workers, otherwise a pool of ``max_workers`` is started per solve.
+    """
+
+    results: dict = {}
+
+    def __init__(self, hospitals, worker, cell_size=1.0, partition_by=None, max_workers=None, executor=None,
+                 **model_options):
+        """Initialize partitioned matching model."""
+        self.hospitals = hospitals
+        self.worker = worker
+        self.cell_size = cell_size
+        self.partition_by = partition_by
+        self.max_workers = max_workers
+        self.executor = executor
+        self.model_options = model_options
+        self.partitions = self.create_partitions()
+
+    def partition_key(self, hospital):
+        """Get the partition a hospital belongs to."""
+        if self.partition_by:
+            return hospital.get(self.partition_by)
+        x, y = hospital["location"]["coordinates"]
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def create_partitions(self):
+        """Group hospital and helper positions into partitions."""
+        partitions = {}
+        hospital_partitions = []
+        for i, h in enumerate(self.hospitals):
+            hospital_partition = partitions.setdefault(self.partition_key(h), ([], []))
+            hospital_partition[0].append(i)
+            hospital_partitions.append(hospital_partition)
+        if self.hospitals:
+            for j, i in enumerate(self.nearest_demanding_hospitals()):
+                hospital_partitions[i][1].append(j)
+        return list(partitions.values())
+
+    def nearest_demanding_hospitals(self):
+        """Find the position of the nearest hospital demanding an activity of each helper.
+
+        Helpers whose activities no hospital demands get the nearest hospital.
+        """
+        metric = self.model_options.get("metric", "euclidean")
+        coords_h, coords_w = coordinates(self.hospitals), coordinates(self.worker)
+        by_activities = {}
+        for j, w in enumerate(self.worker):
+            by_activities.setdefault(frozenset(w["activity_ids"]), []).append(j)
+        nearest = [0] * len(self.worker)
+        for activities, positions in by_activities.items():
+            candidates = [i for i, h in enumerate(self.hospitals)
+                          if any(h["demand"].get(activity, 0) > 0 for activity in activities)]
+            candidates = candidates or list(range(len(self.hospitals)))
+            for j, k in zip(positions, nearest_positions(coords_w[positions], coords_h[candidates], metric)):
+                nearest[j] = candidates[k]
+        return nearest
+
+    def solve(self):
+        """Solve all partitions in parallel and merge their allocations."""
+        problems = [([self.hospitals[i] for i in hospital_positions], [self.worker[j] for j in worker_positions], self.model_options)
+                    for hospital_positions, worker_positions in self.partitions]
+        if self.executor is not None:
+            partition_results = list(self.executor.map(solve_partition, problems))
+        else:
+            with create_executor(self.max_workers) as executor:
+                partition_results = list(executor.map(solve_partition, problems))
+
+        allocations = [None] * len(self.hospitals)
+        remaining_demand = [None] * len(self.hospitals)
+        for (hospital_positions, _), results in zip(self.partitions, partition_results):
+            for i, allocation, demand in zip(hospital_positions, results["allocations"], results["remaining_demand"]):
+                allocations[i] = allocation
+                remaining_demand[i] = demand
+        border_results = self.solve_border(allocations, remaining_demand)
+        if border_results is not None:
+            partition_results.append(border_results)
+        statuses = {r["status"] for r in partition_results}
+        if statuses <= {"OPTIMAL"}:
+            status = "OPTIMAL"
+        elif statuses <= {"OPTIMAL", "FEASIBLE"}:
+            status = "FEASIBLE"
+        else:
+            status = sorted(statuses - {"OPTIMAL", "FEASIBLE"})[0]
+        self.results = {"objective": sum(r["objective"] for r in partition_results),
+                        "bound": sum(r["bound"] for r in partition_results),
+                        "status": status,
+                        "allocations": allocations}
+
+    def solve_border(self, allocations, remaining_demand):
+        """Match the unallocated helpers to the remaining demand of all partitions.
+
+        Adds the helpers to the allocations and returns the results of the
+        border round, None if there was nothing left to match.
+        """
+        allocated = {helper_id for allocation in allocations for helper_id in allocation["helper_ids"]}
+        hospital_positions = [i for i, demand in enumerate(remaining_demand) if any(v > 0 for v in demand.values())]
+        worker = [w for w in self.worker if str(w["_id"]) not in allocated]
+        if not hospital_positions or not worker:
+            return None
+        hospitals = [{**self.hospitals[i], "demand": remaining_demand[i]} for i in hospital_positions]
+        model = MatchingModel(hospitals=hospitals, worker=worker, **self.model_options)
+        model.solve()
+        for i, allocation in zip(hospital_positions, model.results["allocations"]):
+            allocations[i]["helper_ids"].extend(allocation["helper_ids"])
+        return model.results
+
+
+def create_executor(max_workers=None):
+    """Create a process pool for solving partitions.
+
+    The workers are spawned instead of forked, as solves run in threads of
+    the API process and forking a multi-threaded process is unsafe.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def solve_partition(problem):
+    """Solve a single partition (runs in a worker process).
+
+    Returns the results with the demand left per hospital.
+    """
+    hospitals, worker, model_options = problem
+    model = MatchingModel(hospitals=hospitals, worker=worker, **model_options)
+    model.solve()
+    remaining_demand = [dict(h["demand"]) for h in hospitals]
+    for (i, _), skill in model.allocated_skills.items():
+        remaining_demand[i][skill] -= 1
+    return {**model.results, "remaining_demand": remaining_demand}
+
+
+class IncrementalMatching:
+    """Keep the last matching solution and re-solve only what changed.
+
+    The first ``solve`` solves the complete problem. Inserted helpers and
+    hospitals or changed demands are recorded once ``track_changes`` was
+    called and applied at the start of the next ``solve``. They mark their
+    neighbourhood as affected: the touched hospitals plus every hospital within
+    ``neighbourhood`` distance. The next ``solve`` only re-solves the affected
+    hospitals together with the helpers allocated to them and the unallocated
+    helpers within ``neighbourhood``; all other allocations are kept. The
+    previous solution is passed to CP-SAT as a hint. The reported bound is
+    the objective plus the gap left in the last re-solved part. If a re-solve
+    finds no solution, e.g. within ``max_time``, the previous allocations are
+    kept, the bound is None unless the solver proved one and the changes are
+    re-solved on the next call.
+
+    The state lives in the process, so every API process keeps its own copy
+    and only sees the changes recorded through it. Writes from elsewhere, such
+    as other processes, imports or deletions, are only picked up by loading
+    the complete problem again, see ``needs_reload``.
+    """
+
+    def __init__(self, neighbourhood, partition_options=None, **model_options):
+        """Initialize incremental matching."""
+        self.neighbourhood = neighbourhood
+        self.partition_options = partition_options
+        self.model_options = model_options
+        self.metric = model_options.get("metric", "euclidean")
+        self.loaded = False
+        self.loaded_at = None
+        self.results = None
+        self.tracking = False
+        self.changes = deque()
+        self.status = None
+        self.gap = 0
+        self.solved = False
+
+    def track_changes(self):
+        """Start recording changes; call this before reading the data to load."""
+        self.tracking = True
+
+    def load(self, hospitals, worker):
+        """Load the complete problem, discarding any previous solution."""
+        self.hospitals = [dict(h) for h in hospitals]
+        self.worker = list(worker)
+        self.hospital_positions = {str(h["_id"]): i for i, h in enumerate(self.hospitals)}
+        self.worker_positions = {str(w["_id"]): j for j, w in enumerate(self.worker)}
+        self.allocated_to = {}
+        self.scores = [0] * len(self.hospitals)
+        self.touched_hospitals = set()
+        self.new_worker = set()
+        self.results = None
+        self.solved = False
+        self.loaded = True
+        self.loaded_at = time.monotonic()
+
+    def needs_reload(self, max_age=None):
+        """Check if the problem is not loaded or was loaded over ``max_age`` seconds ago."""
+        return not self.loaded or (max_age is not None and time.monotonic() - self.loaded_at > max_age)
+
+    def reset(self):
+        """Forget the loaded problem, its solution and recorded changes."""
+        self.loaded = False
+        self.loaded_at = None
+        self.results = None
+        self.tracking = False
+        self.changes = deque()
+
+    def add_hospital(self, hospital):
+        """Record a new hospital, which is ignored without a location."""
+        if self.tracking:
+            self.changes.append((self._add_hospital, (hospital,)))
+
+    def add_helper(self, helper):
+        """Record a new helper, which is ignored without a location."""
+        if self.tracking:
+            self.changes.append((self._add_helper, (helper,)))
+
+    def update_demand(self, hospital_id, demand):
+        """Record the new demand of a hospital."""
+        if self.tracking:
+            self.changes.append((self._update_demand, (hospital_id, demand)))
+
+    def apply_changes(self):
+        """Apply the recorded changes to the loaded problem.
+
+        Changes may already be part of the loaded data if they were written
+        while it was read, so applying them is idempotent.
+        """
+        while self.changes:
+            apply, args = self.changes.popleft()
+            apply(*args)
+
+    def _add_hospital(self, hospital):
+        if str(hospital["_id"]) in self.hospital_positions or not hospital.get("location"):
+            return
+        hospital = {**hospital, "demand": hospital.get("demand", {})}
+        self.hospital_positions[str(hospital["_id"])] = len(self.hospitals)
+        self.hospitals.append(hospital)
+        self.scores.append(0)
+
+    def _add_helper(self, helper):
+        if str(helper["_id"]) in self.worker_positions or not helper.get("location"):
+            return
+        self.worker_positions[str(helper["_id"])] = len(self.worker)
+        self.new_worker.add(len(self.worker))
+        self.worker.append(helper)
+
+    def _update_demand(self, hospital_id, demand):
+        i = self.hospital_positions.get(str(hospital_id))
+        if i is None:
+            return
+        self.hospitals[i]["demand"] = demand
+        self.touched_hospitals.add(i)
+
+    def solve(self):
+        """Solve the affected part of the problem (everything on the first call)."""
+        self.apply_changes()
+        if not self.solved:
+            self.solved = self.solve_subproblem(list(range(len(self.hospitals))), list(range(len(self.worker))))
+            changes_solved = self.solved
+        elif self.touched_hospitals or self.new_worker:
+            hospital_positions, worker_positions = self.affected()
+            changes_solved = self.solve_subproblem(hospital_positions, worker_positions)
+        else:
+            changes_solved = True
+        if changes_solved:
+            self.touched_hospitals = set()
+            self.new_worker = set()
+        self.results = {
+            "objective": float(sum(self.scores)),
+            "bound": None if self.gap is None else float(sum(self.scores) + self.gap),
+            "status": self.status,
+            "allocations": [{"hospital_id": str(h["_id"]), "helper_ids": []} for h in self.hospitals]
+        }
+        for j in sorted(self.allocated_to):
+            self.results["allocations"][self.allocated_to[j]]["helper_ids"].append(str(self.worker[j]["_id"]))
+
+    def affected(self):
+        """Find the hospital and helper positions to re-solve."""
+        coords_h = coordinates(self.hospitals)
+        coords_w = coordinates(self.worker)
+        touched = set(self.touched_hospitals)
+        if self.new_worker and self.hospitals:
+            new_worker = sorted(self.new_worker)
+            touched.update(nearest_positions(coords_w[new_worker], coords_h, self.metric))
+        touched = sorted(touched)
+        near_hospitals = distance_matrix(coords_h[touched], coords_h, self.metric) <= self.neighbourhood
+        hospital_positions = [int(i) for i in np.nonzero(near_hospitals.any(axis=0))[0]]
+        hospital_set = set(hospital_positions)
+
+        unallocated = [j for j in range(len(self.worker)) if j not in self.allocated_to]
+        near_worker = distance_matrix(coords_h[hospital_positions], coords_w[unallocated], self.metric) <= self.neighbourhood
+        worker_positions = {unallocated[k] for k in np.nonzero(near_worker.any(axis=0))[0]}
+        worker_positions.update(j for j, i in self.allocated_to.items() if i in hospital_set)
+        return hospital_positions, sorted(worker_positions)
+
+    def solve_subproblem(self, hospital_positions, worker_positions):
+        """Solve a sub-problem and replace the allocations of its hospitals.
+
+        Returns whether a solution was found, otherwise the allocations are kept.
+        """
+        hospitals = [self.hospitals[i] for i in hospital_positions]
+        worker = [self.worker[j] for j in worker_positions]
+        if self.partition_options is not None and not self.solved:
+            model = PartitionedMatchingModel(hospitals=hospitals, worker=worker, **self.partition_options, **self.model_options)
+        else:
+            model = MatchingModel(hospitals=hospitals, worker=worker, hint=self.results, **self.model_options)
+        model.solve()
+        self.status = model.results["status"]
+        solved = self.status in ("OPTIMAL", "FEASIBLE")
+        if solved:
+            for j in worker_positions:
+                self.allocated_to.pop(j, None)
+            for i, allocation in zip(hospital_positions, model.results["allocations"]):
+                positions = [self.worker_positions[helper_id] for helper_id in allocation["helper_ids"]]
+                for j in positions:
+                    self.allocated_to[j] = i
+                distances = distance_matrix(coordinates([self.hospitals[i]]), coordinates([self.worker[j] for j in positions]), self.metric)
+                self.scores[i] = int((100 - distances).sum())
+        else:
+            logger.warning(f"re-solving {len(hospital_positions)} hospitals ended with status {self.status}, "
+                           "keeping the previous allocations")
+        # the solver's bound of the re-solved part replaces the scores kept there,
+        # a bound below them wasn't proven (CP-SAT reports 0 without any search)
+        gap = model.results["bound"] - sum(self.scores[i] for i in hospital_positions)
+        self.gap = gap if solved or gap >= 0 else None
+        return solved
+
+
+def coordinates(documents):
+    """Get the location coordinates of documents as an array."""
+    return np.array([d["location"]["coordinates"] for d in documents], dtype=float).reshape(-1, 2)
+
+
+def distance_matrix(coords_a, coords_b, metric="euclidean"):
+    """Calculate the integer distance matrix between two coordinate arrays."""
+    if metric == "euclidean":
+        delta = coords_a[:, np.newaxis, :] - coords_b[np.newaxis, :, :]
+        distances = 10 * np.sqrt((delta ** 2).sum(axis=2))
+    elif metric == "haversine":
+        distances = haversine_distances(coords_a, coords_b)
+    else:
+        raise ValueError(f"Unknown distance metric {metric!r}")
+    return distances.astype(int)
+
+
+def pair_distances(coords_a, coords_b, metric="euclidean"):
+    """Calculate the integer distances between corresponding points of two coordinate arrays."""
+    if metric == "euclidean":
+        distances = 10 * np.sqrt(((coords_a - coords_b) ** 2).sum(axis=1))
+    elif metric == "haversine":
+        lon_a, lat_a = np.radians(coords_a).T
+        lon_b, lat_b = np.radians(coords_b).T
+        distances = great_circle_distances(lon_a, lat_a, lon_b, lat_b)
+    else:
+        raise ValueError(f"Unknown distance metric {metric!r}")
+    return distances.astype(int)
+
+
+def nearest_positions(coords_from, coords_to, metric="euclidean", chunk_size=10000):
+    """Find the position of the nearest point in coords_to for each point in coords_from.
+
+    Works in chunks so the intermediate distance matrix stays small.
+    """
+    nearest = []
+    for start in range(0, len(coords_from), chunk_size):
+        chunk = coords_from[start:start + chunk_size]
+        if metric == "euclidean":
+            delta = chunk[:, np.newaxis, :] - coords_to[np.newaxis, :, :]
+            distances = (delta ** 2).sum(axis=2)
+        elif metric == "haversine":
+            distances = haversine_distances(chunk, coords_to)
+        else:
+            raise ValueError(f"Unknown distance metric {metric!r}")
+        nearest.extend(int(i) for i in distances.argmin(axis=1))
+    return nearest
+
+
+def haversine_distances(coords_a, coords_b):
+    """Great-circle distances in km between two arrays of (lon, lat) points."""
+    lon_a, lat_a = np.radians(coords_a).T[:, :, np.newaxis]
+    lon_b, lat_b = np.radians(coords_b).T[:, np.newaxis, :]
+    return great_circle_distances(lon_a, lat_a, lon_b, lat_b)
+
+
+def great_circle_distances(lon_a, lat_a, lon_b, lat_b):
+    """Great-circle distances in km between broadcast arrays of radians."""
+    a = np.sin((lat_b - lat_a) / 2) ** 2 + np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
@@ -1,8 +1,10 @@
 
+from datetime import datetime
 from enum import Enum
 from typing import List, Optional, Union, Dict, Tuple
 
 from pydantic import BaseModel
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
 
 from wirvsvirus import db
 
@@ -28,8 +30,23 @@ class RoleEnum(str, Enum):
 
 
 class Location(db.MongoModel):
+    """GeoJSON point with (longitude, latitude) coordinates."""
     type: str
-    coordinates: Tuple[int, int]
+    coordinates: Tuple[float, float]
+
+
+class BaseProfile(db.MongoModel):
+    """Profile created on the first login, before signing up.
+
+    It only holds the verified email address; POST /profile completes it
+    with the profile type.
+    """
+    id: Optional[str] = None
+    user_id: str  # provided by auth0
+    email: str
+    profile_type: Optional[ProfileTypeEnum] = None
+    helper_id: Optional[str] = None
+    hospital_id: Optional[str] = None
 
 
 class ProfileBase(db.MongoModel):
@@ -157,6 +174,17 @@ class Hospital(HospitalBase):
     id: str
 
 
+class PartialHospital(Hospital):
+    """Hospital loaded with a projection of its fields."""
+    name: Optional[str] = None
+    address: Optional[str] = None
+
+
+class NearestHospital(Hospital):
+    """Hospital found by a position."""
+    distance: float  # in meters
+
+
 class Proposition(db.MongoModel):
     hospital_id: str
     helper_ids: List[str]
@@ -164,6 +192,28 @@ class Proposition(db.MongoModel):
 
 class MatchProposition(db.MongoModel):
     allocations: List[Proposition]
+    objective: Optional[float] = None
+    bound: Optional[float] = None  # best objective bound proven by the solver
+    status: Optional[str] = None  # solver status, "FEASIBLE" if stopped early
+    data_version: Optional[int] = None  # data version the allocations were computed for
+    computed_at: Optional[datetime] = None
+    stale: bool = False  # data changed since the allocations were computed
 
 
 ProfileInput.update_forward_refs()
+
+
+# Indexes of the collections, applied by "db.ensure_indexes".
+INDEXES: Dict[str, List[IndexModel]] = {
+    'profiles': [IndexModel([('user_id', ASCENDING)], unique=True)],
+    'hospitals': [
+        IndexModel([('location', GEOSPHERE)]),
+        IndexModel([('address_state', ASCENDING), ('_id', ASCENDING)]),  # paginated GraphQL filter
+    ],
+    'helpers': [IndexModel([('email', ASCENDING)])],  # helper imports upsert by email
+    'personnel_requirements': [IndexModel([('hospital_id', ASCENDING)])],
+    'matches': [
+        IndexModel([('helper_id', ASCENDING)]),
+        IndexModel([('personnel_requirement_id', ASCENDING)]),
+    ],
+}
@@ -0,0 +1,92 @@
+"""Cached match propositions recomputed in the background."""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class PropositionCache:
+    """Serve the latest match propositions and recompute them in the background.
+
+    Every write to the matching data calls ``invalidate``, which bumps the
+    data version and schedules a recomputation after ``debounce`` seconds.
+    Further writes within that time push the recomputation back, so a burst
+    of sign-ups results in a single solve. Only the very first ``get`` waits
+    for a computation; afterwards the cached propositions are returned
+    immediately together with the data version they were computed for.
+
+    Writes that don't call ``invalidate``, e.g. from other processes, are
+    caught up with by recomputing propositions older than ``max_age`` seconds
+    on the next ``get``.
+    """
+
+    def __init__(self, compute, debounce: float = 1.0, max_age: float = None):
+        """Initialize cache.
+
+        ``compute`` is a coroutine function returning the propositions.
+        """
+        self.compute = compute
+        self.debounce = debounce
+        self.max_age = max_age
+        self.reset()
+
+    def reset(self):
+        """Drop the cached propositions and any scheduled recomputation."""
+        if getattr(self, '_timer', None):
+            self._timer.cancel()
+        self.data_version = 0
+        self.version = None
+        self.propositions = None
+        self.computed_at = None
+        self._computed = None
+        self._timer = None
+        self._task = None
+
+    def invalidate(self):
+        """Record a data change and schedule a debounced recomputation."""
+        self.data_version += 1
+        if self._timer:
+            self._timer.cancel()
+        self._timer = asyncio.get_event_loop().call_later(self.debounce, self._start)
+
+    async def get(self) -> dict:
+        """Get the latest propositions with their data version."""
+        if self.propositions is None:
+            await asyncio.shield(self._start())
+        elif self.expired() and self._timer is None and (self._task is None or self._task.done()):
+            self.invalidate()
+        return {
+            **self.propositions,
+            'data_version': self.version,
+            'computed_at': self.computed_at,
+            'stale': self.version != self.data_version,
+        }
+
+    def expired(self) -> bool:
+        """Check if the propositions were computed over ``max_age`` seconds ago."""
+        return self.max_age is not None and time.monotonic() - self._computed > self.max_age
+
+    def _start(self) -> asyncio.Task:
+        """Start the recomputation unless it is already running."""
+        self._timer = None
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+            self._task.add_done_callback(self._log_failure)
+        return self._task
+
+    async def _run(self):
+        """Recompute until the propositions match the current data version."""
+        while self.version != self.data_version:
+            version = self.data_version
+            propositions = await self.compute()
+            self.propositions, self.version, self.computed_at = propositions, version, datetime.utcnow()
+            self._computed = time.monotonic()
+            logger.info(f'computed match propositions for data version {version}')
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.error('computing match propositions failed', exc_info=task.exception())
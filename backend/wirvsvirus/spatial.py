@@ -0,0 +1,127 @@
+"""In-memory spatial index for (longitude, latitude) points."""
+
+import heapq
+from math import asin, cos, radians, sin, sqrt
+from typing import Any, Dict, List, Tuple
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.19
+
+
+class GridIndex:
+    """Uniform grid over (longitude, latitude) points.
+
+    Points are bucketed into square cells of ``cell_size`` degrees. Searches
+    visit the cells in rings around the query point and stop as soon as no
+    point in a further ring can be closer, so a lookup only touches the
+    points nearby instead of scanning all of them.
+
+    Distances are in degrees for the "euclidean" metric and in kilometres for
+    the "haversine" metric.
+    """
+
+    def __init__(self, cell_size: float = 0.5, metric: str = "haversine"):
+        """Initialize empty index."""
+        if metric not in ("euclidean", "haversine"):
+            raise ValueError(f"Unknown distance metric {metric!r}")
+        self.cell_size = cell_size
+        self.metric = metric
+        self.cells: Dict[Tuple[int, int], List[Tuple[Any, float, float]]] = {}
+        self.bounds = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def cell(self, lon: float, lat: float) -> Tuple[int, int]:
+        """Get the cell a point falls into."""
+        return (int(lon // self.cell_size), int(lat // self.cell_size))
+
+    def insert(self, key, coordinates):
+        """Insert a point under a key."""
+        lon, lat = float(coordinates[0]), float(coordinates[1])
+        x, y = self.cell(lon, lat)
+        self.cells.setdefault((x, y), []).append((key, lon, lat))
+        if self.bounds is None:
+            self.bounds = (x, y, x, y)
+        else:
+            min_x, min_y, max_x, max_y = self.bounds
+            self.bounds = (min(min_x, x), min(min_y, y), max(max_x, x), max(max_y, y))
+        self.size += 1
+
+    def distance(self, lon_a, lat_a, lon_b, lat_b) -> float:
+        """Distance between two points."""
+        if self.metric == "euclidean":
+            return sqrt((lon_a - lon_b) ** 2 + (lat_a - lat_b) ** 2)
+        lon_a, lat_a, lon_b, lat_b = map(radians, (lon_a, lat_a, lon_b, lat_b))
+        a = sin((lat_b - lat_a) / 2) ** 2 + cos(lat_a) * cos(lat_b) * sin((lon_b - lon_a) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * asin(sqrt(min(1.0, a)))
+
+    def ring_distance(self, lat: float, ring: int) -> float:
+        """Lower bound of the distance to any point outside the first ``ring`` rings."""
+        degrees = ring * self.cell_size
+        if self.metric == "euclidean":
+            return degrees
+        # a degree of longitude shrinks towards the poles
+        return degrees * KM_PER_DEGREE * cos(radians(min(89.9, abs(lat) + degrees + self.cell_size)))
+
+    def ring(self, center: Tuple[int, int], ring: int):
+        """Cells at exactly ``ring`` cells (Chebyshev distance) from the center."""
+        x, y = center
+        if ring == 0:
+            yield center
+            return
+        for dx in range(-ring, ring + 1):
+            yield (x + dx, y - ring)
+            yield (x + dx, y + ring)
+        for dy in range(-ring + 1, ring):
+            yield (x - ring, y + dy)
+            yield (x + ring, y + dy)
+
+    def max_ring(self, center: Tuple[int, int]) -> int:
+        """Number of rings needed to cover every occupied cell."""
+        min_x, min_y, max_x, max_y = self.bounds
+        x, y = center
+        return max(x - min_x, max_x - x, y - min_y, max_y - y, 0)
+
+    def nearest(self, coordinates, k: int = 1, max_distance: float = None) -> List[Tuple[float, Any]]:
+        """Find the k nearest points as (distance, key) pairs, closest first."""
+        if not self.size:
+            return []
+        lon, lat = float(coordinates[0]), float(coordinates[1])
+        center = self.cell(lon, lat)
+        best = []  # max-heap of the k closest points seen so far
+        for ring in range(self.max_ring(center) + 1):
+            bound = self.ring_distance(lat, ring - 1) if ring else 0
+            if max_distance is not None and bound > max_distance:
+                break
+            if len(best) == k and bound > -best[0][0]:
+                break
+            for cell in self.ring(center, ring):
+                for index, (key, p_lon, p_lat) in enumerate(self.cells.get(cell, ())):
+                    d = self.distance(lon, lat, p_lon, p_lat)
+                    if max_distance is not None and d > max_distance:
+                        continue
+                    item = (-d, cell, index, key)
+                    if len(best) < k:
+                        heapq.heappush(best, item)
+                    elif d < -best[0][0]:
+                        heapq.heapreplace(best, item)
+        return [(-d, key) for d, _, _, key in sorted(best, reverse=True)]
+
+    def within(self, coordinates, radius: float) -> List[Tuple[float, Any]]:
+        """Find all points within a radius as (distance, key) pairs."""
+        if not self.size:
+            return []
+        lon, lat = float(coordinates[0]), float(coordinates[1])
+        center = self.cell(lon, lat)
+        found = []
+        for ring in range(self.max_ring(center) + 1):
+            if ring and self.ring_distance(lat, ring - 1) > radius:
+                break
+            for cell in self.ring(center, ring):
+                for key, p_lon, p_lat in self.cells.get(cell, ()):
+                    d = self.distance(lon, lat, p_lon, p_lat)
+                    if d <= radius:
+                        found.append((d, key))
+        return found